@@ -0,0 +1,184 @@
+import re
+
+# Post-processing of generated gcode to make it shorter, e.g. for streaming
+# over slow serial links. The program is interpreted move by move, and:
+# - a retract followed by a plunge back to the same depth at the same XY
+#   position is dropped, together with any rapids that do not move,
+# - zero-length G0/G1 moves are dropped,
+# - runs of G1 moves at the same depth and feed that deviate from a straight
+#   line by less than tolerance are merged into a single move,
+# - the G word is only written when the motion mode changes, and only the
+#   axes and feed that change are written (I and J, and X and Y of arcs, are
+#   always written).
+# The coordinates are kept as written in the input, so they are compared as
+# strings. Any line that is not a plain G0-G3 move or feed (tool changes,
+# G90, comments...) is copied as is and makes the machine state unknown.
+
+_word_re = re.compile(r'([A-Z])([-+]?[0-9]*\.?[0-9]*)')
+_move_words = frozenset('GXYZIJF')
+
+class Move(object):
+    __slots__ = ('g', 'x', 'y', 'z', 'i', 'j', 'feed')
+    def __init__(self, g, x, y, z, i, j, feed):
+        self.g = g
+        self.x = x
+        self.y = y
+        self.z = z
+        self.i = i
+        self.j = j
+        self.feed = feed
+
+# Returns the words of a move or feed line as a dict, or None for other lines
+def parse_move(line):
+    text = line.replace(" ", "").upper()
+    words = _word_re.findall(text)
+    if not words or "".join(l + v for l, v in words) != text:
+        return None
+    result = {}
+    for letter, value in words:
+        if letter not in _move_words or letter in result or value == "":
+            return None
+        result[letter] = value
+    if 'G' in result:
+        try:
+            g = int(float(result['G']))
+        except ValueError:
+            return None
+        if g not in (0, 1, 2, 3):
+            return None
+        result['G'] = g
+    return result
+
+# Lines into a list of raw lines (strings) and Moves with absolute positions
+def interpret(lines):
+    items = []
+    g = x = y = z = feed = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        words = parse_move(line)
+        if words is None:
+            items.append(line)
+            g = x = y = z = feed = None
+            continue
+        feed = words.get('F', feed)
+        g = words.get('G', g)
+        if not set(words) & set('XYZ'):
+            if 'G' in words and ('F' not in words or len(words) > 2):
+                # A G word without axes, keep it as it is
+                items.append(line)
+                g = x = y = z = feed = None
+            continue
+        if g is None:
+            items.append(line)
+            x = y = z = feed = None
+            continue
+        x = words.get('X', x)
+        y = words.get('Y', y)
+        z = words.get('Z', z)
+        items.append(Move(g, x, y, z, words.get('I'), words.get('J'), feed))
+    return items
+
+def same_position(a, b):
+    return a.x == b.x and a.y == b.y and a.z == b.z and a.x is not None and a.y is not None and a.z is not None
+
+# Drops the retract/plunge round trips that do not go anywhere, and the
+# zero-length moves
+def drop_idle_moves(items):
+    result = []
+    last = None
+    k = 0
+    while k < len(items):
+        item = items[k]
+        if not isinstance(item, Move):
+            result.append(item)
+            last = None
+            k += 1
+            continue
+        if last is not None and item.g in (0, 1) and same_position(item, last):
+            k += 1
+            continue
+        if last is not None and item.g == 0 and item.x == last.x and item.y == last.y and item.z is not None and last.z is not None and float(item.z) > float(last.z):
+            # Lifted; look for the return to the same depth without moving
+            j = k + 1
+            while j < len(items) and isinstance(items[j], Move) and items[j].g in (0, 1) and items[j].x == last.x and items[j].y == last.y:
+                if items[j].z == last.z:
+                    break
+                j += 1
+            if j < len(items) and isinstance(items[j], Move) and items[j].g in (0, 1) and items[j].x == last.x and items[j].y == last.y and items[j].z == last.z:
+                k = j + 1
+                continue
+        result.append(item)
+        last = item
+        k += 1
+    return result
+
+def point_segment_dist2(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    l2 = dx * dx + dy * dy
+    t = 0.0 if l2 == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / l2))
+    ex, ey = ax + t * dx - px, ay + t * dy - py
+    return ex * ex + ey * ey
+
+# Merges runs of nearly collinear G1 moves at the same depth and feed
+def merge_collinear(items, tolerance, max_run = 64):
+    result = []
+    tol2 = tolerance * tolerance
+    start = None
+    inner = []
+    for item in items:
+        end = result[-1] if result else None
+        mergeable = isinstance(item, Move) and item.g == 1 and isinstance(end, Move) and end.g == 1 and \
+            start is not None and item.z == end.z and item.feed == end.feed and len(inner) < max_run
+        if mergeable:
+            px, py = float(item.x), float(item.y)
+            ax, ay = start
+            points = inner + [(float(end.x), float(end.y))]
+            if all(point_segment_dist2(x, y, ax, ay, px, py) <= tol2 for x, y in points):
+                inner = points
+                result[-1] = item
+                continue
+        # The move starts a new run from the end of the previous one
+        if isinstance(end, Move) and end.x is not None and end.y is not None and isinstance(item, Move) and item.g == 1 and item.z == end.z:
+            start = (float(end.x), float(end.y))
+        else:
+            start = None
+        inner = []
+        result.append(item)
+    return result
+
+# Writes the moves with modal G words and only the changed axes and feed
+def format_items(items):
+    lines = []
+    g = x = y = z = feed = None
+    for item in items:
+        if not isinstance(item, Move):
+            lines.append(item)
+            g = x = y = z = feed = None
+            continue
+        words = []
+        if item.g != g:
+            words.append("G%d" % item.g)
+            g = item.g
+        for letter, value, last in (('X', item.x, x), ('Y', item.y, y), ('Z', item.z, z)):
+            # Arcs always need their endpoint (a full circle ends where it starts)
+            if value is not None and (value != last or (item.g in (2, 3) and letter != 'Z')):
+                words.append(letter + value)
+        x, y, z = item.x, item.y, item.z
+        if item.i is not None:
+            words.append("I" + item.i)
+        if item.j is not None:
+            words.append("J" + item.j)
+        if item.g != 0 and item.feed is not None and item.feed != feed:
+            words.append("F" + item.feed)
+            feed = item.feed
+        lines.append("".join(words))
+    return lines
+
+def compress_gcode(lines, tolerance = 0.002):
+    items = interpret(lines)
+    items = drop_idle_moves(items)
+    if tolerance > 0:
+        items = merge_collinear(items, tolerance)
+    return format_items(items)
@@ -1,5 +1,12 @@
+import os
+import numpy
 from shapely.geometry import *
 from shapely.affinity import *
+from shapely.ops import unary_union
+from shapely.strtree import STRtree
+from shapely.prepared import prep
+from .compress import compress_gcode
+from .simplify import simplify_polyline
 
 def inch2mm(inches):
     return inches * 25.4
@@ -51,6 +58,13 @@ class GcodeOutputBase:
         self.material = material
         self.tool = tool
         self.last_feed = None
+        # Max deviation when removing nearly collinear points of the rings
+        # (mill_ring), 0 = keep all points
+        self.simplify_tolerance = 0
+        # Number of segments before and after the simplification
+        self.segment_counts = [0, 0]
+        # Rapid distance before and after improving the ordering
+        self.rapid_distances = [0.0, 0.0]
         if operation is not None:
             self.zdepth = operation.zsurface
         elif material is not None:
@@ -62,6 +76,12 @@ class GcodeOutputBase:
     def preamble(self):
         self.last_feed = None
         self.write("G90 G17\n")
+    def count_segments(self, before, after):
+        self.segment_counts[0] += before
+        self.segment_counts[1] += after
+    def count_rapids(self, before, after):
+        self.rapid_distances[0] += before
+        self.rapid_distances[1] += after
     def set_depth(self, depth):
         self.zdepth = depth
     def set_material(self, material):
@@ -117,6 +137,33 @@ class GcodeOutputBase:
         self.move_z(self.zdepth)
         self.emit_feed(feed)
         self.write("G3X%0.3fY%0.3fI%0.3fJ%0.3f" % (x, y, i, j))
+    def write_lines(self, lines):
+        for line in lines:
+            self.write(line)
+    # Replays a recorded Toolpath at the current depth. The lines are written
+    # in batches, the Z and feed changes are only checked for.
+    def emit_toolpath(self, toolpath):
+        cut_feed = self.get_feed()
+        pending = []
+        for code, xy, feed in toolpath.moves:
+            if code == "G0":
+                if pending:
+                    self.write_lines(pending)
+                    pending = []
+                self.get_safe()
+            else:
+                if code == "G1":
+                    feed = cut_feed
+                if self.z is None or abs(self.zdepth - self.z) > 0.001 or (feed is not None and feed != self.last_feed):
+                    if pending:
+                        self.write_lines(pending)
+                        pending = []
+                    self.move_z(self.zdepth)
+                    if feed is not None:
+                        self.emit_feed(feed)
+            pending.append(code + xy)
+        if pending:
+            self.write_lines(pending)
     def emit_feed(self, feed):
         if self.last_feed != feed:
             self.last_feed = feed
@@ -129,20 +176,136 @@ class GcodeOutputBase:
             self.move_z(self.material.end_z)
             self.write("G00 X0 Y0")
 
+# Writes to a file, in blocks of block_lines lines. If compress is set, the
+# whole program is passed through compress_gcode at the end instead.
 class GcodeOutput(GcodeOutputBase):
-    def __init__(self, filename, operation = None, material = None, tool = None):
+    block_lines = 8192
+    def __init__(self, filename, operation = None, material = None, tool = None, compress = False):
         GcodeOutputBase.__init__(self, operation = operation, material = material, tool = tool)
+        self.lines = []
+        self.compress = compress
         self.f = open(filename, "w")
         self.preamble()
     def write(self, line):
-        self.f.write(line + "\n")
+        lines = self.lines
+        lines.append(line)
+        if len(lines) >= self.block_lines:
+            self.flush()
+    def write_lines(self, lines):
+        self.lines += lines
+        if len(self.lines) >= self.block_lines:
+            self.flush()
+    def flush(self, final = False):
+        if self.compress and not final:
+            return
+        if self.lines:
+            lines = compress_gcode(self.lines) if self.compress else self.lines
+            self.f.write("\n".join(lines) + "\n")
+            self.lines = []
     def end(self):
         GcodeOutputBase.end(self)
+        self.flush(final = True)
         self.f.close()
 
+# Keeps the output in memory, e.g. for combining several operations into
+# one job; getvalue() returns the text written so far
+class GcodeBuffer(GcodeOutputBase):
+    def __init__(self, operation = None, material = None, tool = None):
+        GcodeOutputBase.__init__(self, operation = operation, material = material, tool = tool)
+        self.lines = []
+        self.preamble()
+    def write(self, line):
+        self.lines.append(line)
+    def write_lines(self, lines):
+        self.lines += lines
+    def getvalue(self, compress = False):
+        lines = compress_gcode(self.lines) if compress else self.lines
+        if not lines:
+            return ""
+        return "\n".join(lines) + "\n"
+
+# Several operations produced into their own GcodeBuffer, written out as a
+# single program with a tool change wherever the tool differs from the one
+# of the previous operation. The operations can also be saved as separate
+# files, from the same buffers. With compress, each operation is passed
+# through compress_gcode.
+class GcodeJob:
+    def __init__(self):
+        self.parts = []
+    # Returns the output the operation is to be written to
+    def add(self, name, operation = None, tool = None, material = None):
+        gc = GcodeBuffer(operation = operation, material = material, tool = tool)
+        self.parts.append((name, gc))
+        return gc
+    def write(self, f, compress = False):
+        last_tool = None
+        for name, gc in self.parts:
+            tool = gc.get_tool()
+            if tool is not None and tool != last_tool:
+                f.write("M6 T%d\n" % tool)
+                last_tool = tool
+            f.write(gc.getvalue(compress))
+    # Number of segments before and after the simplification, in all parts
+    def segment_counts(self):
+        return [sum(gc.segment_counts[i] for name, gc in self.parts) for i in (0, 1)]
+    # Rapid distance before and after improving the ordering, in all parts
+    def rapid_distances(self):
+        return [sum(gc.rapid_distances[i] for name, gc in self.parts) for i in (0, 1)]
+    def save(self, filename, compress = False):
+        with open(filename, "w") as f:
+            self.write(f, compress)
+    # Writes each operation to the file named after it, in directory if given
+    def save_parts(self, directory = None, compress = False):
+        names = []
+        for name, gc in self.parts:
+            fname = name if directory is None else os.path.join(directory, name)
+            with open(fname, "w") as f:
+                f.write(gc.getvalue(compress))
+            names.append(fname)
+        return names
+
+# Moves recorded with the same interface as the outputs, without a depth:
+# the cuts are done at the depth the output is set to when the toolpath is
+# emitted, so it can be built (and the coordinates formatted) once and then
+# emitted for every pass.
+class Toolpath:
+    def __init__(self, grid = 1):
+        self.grid = grid
+        self.moves = []
+    def move_to(self, x, y):
+        self.moves.append(("G0", "X%0.3fY%0.3f" % (self.grid * x, self.grid * y), None))
+    def line_to(self, x, y):
+        self.moves.append(("G1", "X%0.3fY%0.3f" % (self.grid * x, self.grid * y), None))
+    def arc_cw_to(self, x, y, i, j, feed = None):
+        self.moves.append(("G2", "X%0.3fY%0.3fI%0.3fJ%0.3f" % (x, y, i, j), feed))
+    def arc_ccw_to(self, x, y, i, j, feed):
+        self.moves.append(("G3", "X%0.3fY%0.3fI%0.3fJ%0.3f" % (x, y, i, j), feed))
+
+def ring_coords(gc, r):
+    coords = r.coords
+    if gc.simplify_tolerance > 0:
+        before = len(coords)
+        coords = simplify_polyline(list(coords), gc.simplify_tolerance)
+        gc.count_segments(before, len(coords))
+    return coords
+
+def trace_ring(gc, coords):
+    gc.move_to(coords[-1][0], coords[-1][1])
+    for pt in coords:
+        gc.line_to(pt[0], pt[1])
+
 def mill_ring(gc, r):
-    gc.move_to(r.coords[-1][0], r.coords[-1][1])
-    for pt in r.coords:
+    trace_ring(gc, ring_coords(gc, r))
+
+# Moves of mill_ring, recorded once to be emitted at every depth
+def ring_toolpath(gc, r):
+    toolpath = Toolpath(gc.grid)
+    trace_ring(toolpath, ring_coords(gc, r))
+    return toolpath
+
+def mill_polyline(gc, pts):
+    gc.move_to(pts[0][0], pts[0][1])
+    for pt in pts[1:]:
         gc.line_to(pt[0], pt[1])
 
 def mill_shape(gc, p, tool):
@@ -161,16 +324,143 @@ def mill_shape(gc, p, tool):
         raise ValueError("Unsupported type")
     return milled
 
-def mill_poly(gc, p, tool):
-    p = p.buffer(-tool * 0.5, 30, 2, 2, mitre_limit = 0.1)
+def polygon_rings(p):
+    rings = []
+    for poly in getattr(p, 'geoms', [p]):
+        if type(poly) is Polygon and not poly.is_empty:
+            rings.append(poly.exterior)
+            rings += poly.interiors
+    return rings
+
+# Region the centre of the tool stays in when pocketing p
+def pocket_area(p, tool):
+    return p.buffer(-tool * 0.5, quad_segs = 30, cap_style = 2, join_style = 2, mitre_limit = 0.1)
+
+# Rings milled when pocketing the shape whose pocket_area is area, from the
+# outside in: area shrunk by stepover tool widths at a time, each offset a
+# single negative buffer of area. With stepover up to about 0.85, nothing is
+# left in the corners of 90 degrees or more.
+pocket_stepover = 0.85
+
+def offset_rings(area, tool, stepover = pocket_stepover):
+    rings = []
+    p = area
+    step = 0
     while not p.is_empty:
-        milled = mill_shape(gc, p, tool)
-        if milled.is_empty:
-            break
-        p = p.difference(milled)
-        #p = p.buffer(-tool, 30, 2, 2, mitre_limit = 0.1)
-        if p.is_empty:
-            break
+        rings += polygon_rings(p)
+        step += 1
+        p = area.buffer(-step * stepover * tool, quad_segs = 30, cap_style = 2, join_style = 2, mitre_limit = 0.1)
+    return rings
+
+# Rings around the corners and narrow parts of area that are not within half
+# a tool width of any of the rings, until there are none left
+def rest_rings(area, rings, tool):
+    result = []
+    rest = area
+    new = rings
+    while new:
+        rest = rest.difference(unary_union([r.buffer(tool * 0.5, quad_segs = 8) for r in new]))
+        new = polygon_rings(rest)
+        result += new
+    return result
+
+def pocket_rings(area, tool, stepover = pocket_stepover):
+    rings = offset_rings(area, tool, stepover)
+    return rings + rest_rings(area, rings, tool)
+
+# Joins closed rings (lists of points) into polylines, to be milled without
+# lifting the tool in between. From the end of each ring (or from start),
+# the nearest of the link_candidates nearest rings that can be linked to is
+# milled next, entered at its nearest point, and appended to the same
+# polyline; if none can, the nearest ring starts a new polyline. A link must
+# stay within area (widened by tolerance), and either within the material
+# already cleared by an endmill of diameter tool along the rings milled so
+# far, or be no longer than a stepover. The rings in done were milled before
+# and count as cleared.
+link_candidates = 8
+
+def link_rings(rings, area, tool, tolerance = 0.001, start = None, done = ()):
+    rings = [numpy.asarray(ring, dtype = float).reshape(-1, 2) for ring in rings]
+    if not rings:
+        return []
+    allowed = prep(area.buffer(tolerance))
+    lines = [LineString(ring) for ring in rings] + [LineString(ring) for ring in done]
+    tree = STRtree(lines)
+    milled = numpy.arange(len(lines)) >= len(rings)
+    swept = {}
+    def cleared(link):
+        if link.length <= pocket_stepover * tool + tolerance:
+            return True
+        rest = link
+        for i in tree.query(link, predicate = 'dwithin', distance = tool * 0.5):
+            if milled[i]:
+                if i not in swept:
+                    swept[i] = prep(lines[i].buffer(tool * 0.5 + tolerance, quad_segs = 8))
+                if swept[i].covers(rest):
+                    return True
+                rest = rest.difference(swept[i].context)
+        return rest.is_empty
+    # Points of the rings not milled yet, with the index of their ring
+    pts = numpy.concatenate([ring[:-1] for ring in rings])
+    owner = numpy.repeat(numpy.arange(len(rings)), [len(ring) - 1 for ring in rings])
+    polylines = []
+    last = start
+    for n in range(len(rings)):
+        if last is None:
+            candidates = [(0, 0)]
+        else:
+            d = pts - last
+            d2 = numpy.einsum('ij,ij->i', d, d)
+            # Each ring entered at its nearest point, nearest ring first
+            firsts = numpy.flatnonzero(numpy.r_[True, owner[1:] != owner[:-1]])
+            candidates = []
+            for c in numpy.argsort(numpy.minimum.reduceat(d2, firsts), kind = 'stable')[:link_candidates]:
+                first = firsts[c]
+                candidates.append((first, first + int(d2[first:first + len(rings[owner[first]]) - 1].argmin())))
+        # The nearest ring that can be linked to, else the nearest one
+        first, k = candidates[0]
+        linked = False
+        if polylines:
+            for f, j in candidates:
+                link = LineString([last, pts[j]])
+                if allowed.covers(link) and cleared(link):
+                    first, k, linked = f, j, True
+                    break
+        r = owner[first]
+        i = k - first
+        pts = numpy.delete(pts, numpy.s_[first:first + len(rings[r]) - 1], axis = 0)
+        owner = numpy.delete(owner, numpy.s_[first:first + len(rings[r]) - 1])
+        ring = numpy.concatenate([rings[r][i:-1], rings[r][:i + 1]]).tolist()
+        if linked:
+            polylines[-1] += ring
+        else:
+            polylines.append(ring)
+        milled[r] = True
+        last = ring[-1]
+    return polylines
+
+# Pocketing moves for p, recorded once to be emitted at every depth. With
+# linked, all the rings are joined with link_rings, so the tool is only
+# lifted when the way to the next ring leaves the pocket or goes through
+# more uncut material than a stepover. Otherwise the
+# offsets are milled from the outside in, and only the rings of the leftover
+# corners are joined.
+def pocket_toolpath(gc, p, tool, linked = False):
+    area = pocket_area(p, tool)
+    if linked:
+        rings = link_rings([ring_coords(gc, r) for r in pocket_rings(area, tool)], area, tool)
+    else:
+        offsets = offset_rings(area, tool)
+        rings = [ring_coords(gc, r) for r in offsets]
+        rest = [ring_coords(gc, r) for r in rest_rings(area, offsets, tool)]
+        rings += link_rings(rest, area, tool, start = rings[-1][-1] if rings else None, done = rings)
+    toolpath = Toolpath(gc.grid)
+    for pts in rings:
+        mill_polyline(toolpath, pts)
+    return toolpath
+
+def mill_poly(gc, p, tool, linked = False):
+    gc.emit_toolpath(pocket_toolpath(gc, p, tool, linked))
 
 def layerbylayer(gc, operation, depth = None, init_depth = None):
     if depth is None:
@@ -191,21 +481,23 @@ def layerbylayer2(gc, operation, zstep, final_depth, init_depth):
         gc.set_depth(zdepth)
         operation(gc)
 
-def pocket_poly(gc, p, tool, depth = None, init_depth = None):
-    layerbylayer(gc, lambda gc: mill_poly(gc, p, tool), depth, init_depth)
+def pocket_poly(gc, p, tool, depth = None, init_depth = None, linked = False):
+    toolpath = pocket_toolpath(gc, p, tool, linked)
+    layerbylayer(gc, lambda gc: gc.emit_toolpath(toolpath), depth, init_depth)
 
 def profile_poly(gc, p, depth = None, init_depth = None):
-    layerbylayer(gc, lambda gc: mill_ring(gc, p.exterior), depth, init_depth)
+    toolpath = ring_toolpath(gc, p.exterior)
+    layerbylayer(gc, lambda gc: gc.emit_toolpath(toolpath), depth, init_depth)
 
 # For outline milling
 def profile_poly_tooloutside(gc, p, tool, depth = None, init_depth = None):
-    p = p.buffer(tool / 2.0).exterior
-    layerbylayer(gc, lambda gc: mill_ring(gc, p), depth, init_depth)
+    toolpath = ring_toolpath(gc, p.buffer(tool / 2.0).exterior)
+    layerbylayer(gc, lambda gc: gc.emit_toolpath(toolpath), depth, init_depth)
 
 # For cutout milling
 def profile_poly_toolinside(gc, p, tool, depth = None, init_depth = None):
-    p = p.buffer(-tool / 2.0).exterior
-    layerbylayer(gc, lambda gc: mill_ring(gc, p), depth, init_depth)
+    toolpath = ring_toolpath(gc, p.buffer(-tool / 2.0).exterior)
+    layerbylayer(gc, lambda gc: gc.emit_toolpath(toolpath), depth, init_depth)
 
 
 def get_ring_or_line(shape, is_last):
@@ -222,11 +514,23 @@ def get_ring_or_line(shape, is_last):
 def find_material_and_tool(gc, material, tool):
     return material if material is not None else gc.material, tool if tool is not None else gc.tool
 
+# The cuts build their moves (make_toolpath) once for each tool and output
+# settings, and emit them for every layer; only the depth changes
 class BaseCut:
     def __init__(self, shape, init_depth = None, final_depth = None):
         self.shape = shape
         self.init_depth = init_depth
         self.final_depth = final_depth
+        self.toolpaths = {}
+    def get_toolpath(self, gc, tool):
+        key = (tool, gc.grid, gc.simplify_tolerance)
+        if key not in self.toolpaths:
+            self.toolpaths[key] = self.make_toolpath(gc, tool)
+        return self.toolpaths[key]
+    def run(self, gc, material = None, tool = None):
+        material, tool = find_material_and_tool(gc, material, tool)
+        toolpath = self.get_toolpath(gc, tool)
+        layerbylayer2(gc, lambda gc: gc.emit_toolpath(toolpath), material.layer_depth, self.get_final_depth(material), self.get_init_depth(material))
     def get_init_depth(self, material):
         return material.surface if self.init_depth is None else self.init_depth
     def get_final_depth(self, material):
@@ -259,22 +563,22 @@ class ProfileCut(BaseCut):
     @staticmethod
     def hole(x, y, diameter):
         return ProfileCut(Point(x, y).buffer(0.5 * diameter), ProfileCut.TOOL_IS_INSIDE)
-    def run(self, gc, material = None, tool = None):
-        material, tool = find_material_and_tool(gc, material, tool)
+    def make_toolpath(self, gc, tool):
         p = self.shape.buffer(self.tool_location * tool / 2.0).exterior
         if p is None:
             raise ValueError("Cannot mill the shape with tool diameter %f" % tool)
-        layerbylayer2(gc, lambda gc: mill_ring(gc, p), material.layer_depth, self.get_final_depth(material), self.get_init_depth(material))
+        return ring_toolpath(gc, p)
 
 class PocketingCut(BaseCut):
-    def __init__(self, shape, init_depth = None, final_depth = None):
+    # linked: keep the tool down between the rings where possible (mill_poly)
+    def __init__(self, shape, init_depth = None, final_depth = None, linked = False):
         BaseCut.__init__(self, shape, init_depth, final_depth)
+        self.linked = linked
     @staticmethod
-    def hole(x, y, diameter):
-        return PocketingCut(Point(x, y).buffer(0.5 * diameter))
-    def run(self, gc, material = None, tool = None):
-        material, tool = find_material_and_tool(gc, material, tool)
-        layerbylayer2(gc, lambda gc: mill_poly(gc, self.shape, tool), material.layer_depth, self.get_final_depth(material), self.get_init_depth(material))
+    def hole(x, y, diameter, linked = False):
+        return PocketingCut(Point(x, y).buffer(0.5 * diameter), linked = linked)
+    def make_toolpath(self, gc, tool):
+        return pocket_toolpath(gc, self.shape, tool, self.linked)
 
 class CutSequence:
     def __init__(self, material = None, tool = None):
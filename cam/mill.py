@@ -1,6 +1,16 @@
+import collections
 import math
+import multiprocessing
 import sys
-from .gcode import GcodeOutput
+import numpy
+import shapely.affinity
+import shapely.geometry
+import shapely.ops
+import shapely.wkb
+from .gcode import GcodeOutput, GcodeBuffer, GcodeJob, Toolpath, link_rings, pocket_area, pocket_rings
+from .pathcache import cached_value
+from .simplify import simplify_polyline
+from .tour import improve_tour
 from PyQt5 import QtCore, QtGui
 
 def addvec(v1, v2):
@@ -10,6 +20,32 @@ class MillingParams(object):
     def __init__(self):
         self.tool_width = 0.3
         self.doubleIsolation = False
+        # Number of isolation passes, each extra one offset from the previous
+        # one by isolation_stepover tool widths (supersedes doubleIsolation)
+        self.isolation_passes = 1
+        self.isolation_stepover = 0.5
+        # Number of worker processes for per-net path generation (0 = all cores)
+        self.processes = 1
+        # How the primitives of a net are merged: 'incremental' or 'pairwise'
+        self.union_strategy = 'incremental'
+        # Geometry library used for toolpath generation: 'qt' or 'shapely'
+        self.backend = 'qt'
+        # Time budget in seconds for improving the greedy ordering of each
+        # operation with 2-opt/Or-opt (0 = greedy ordering only)
+        self.tour_time = 0
+        # Drill the holes ordered by size, smallest first; no tool change is
+        # made between the sizes, all holes are milled with the same endmill
+        self.group_holes = False
+        # Max deviation in mm when removing nearly collinear points from the
+        # isolation contours (0 = keep all points)
+        self.simplify_tolerance = 0
+
+    # Number of isolation passes milled: with isolation_passes > 1,
+    # doubleIsolation adds one more
+    def total_isolation_passes(self):
+        if self.isolation_passes > 1 and self.doubleIsolation:
+            return self.isolation_passes + 1
+        return self.isolation_passes
 
 class ViewParams(object):
     def __init__(self, ymirror = False):
@@ -24,6 +60,8 @@ class ViewParams(object):
     def is_ymirrored(self):
         return self.ymirror
 
+# Board extents, from the per-layer extents cached by PCBLayer (the spatial
+# index is not needed for the whole board)
 class BoardSizer(object):
     def __init__(self, board):
         self.board = board
@@ -33,17 +71,10 @@ class BoardSizer(object):
         self.minpt = None
         self.maxpt = None
         if self.board is not None:
-            for l in list(self.board.layers.values()):
-                for seg in l.segments:
-                    self.addPointToBB(seg.start)
-                    self.addPointToBB(seg.end)
-                for seg in l.gr_lines:
-                    self.addPointToBB(seg.start)
-                    self.addPointToBB(seg.end)
-                for net, polygons in list(l.polygons.items()):
-                    for p in polygons:
-                        for pt in p:
-                            self.addPointToBB(pt)
+            extents = self.board.get_extents()
+            if extents is not None:
+                self.minpt = (extents[0], extents[1])
+                self.maxpt = (extents[2], extents[3])
         if self.minpt is None:
             self.minpt = (0, 0)
             self.maxpt = (0, 0)
@@ -57,6 +88,9 @@ class BoardSizer(object):
             self.maxpt = (max(self.maxpt[0], curPt[0]), max(self.maxpt[1], curPt[1]))
 
 class PathGenerator(object):
+    # Scale used for geometry that does not depend on the zoom level
+    reference_scale = 10.0
+
     def __init__(self, view, milling_params):
         super(PathGenerator, self).__init__()
         self.view = view
@@ -86,87 +120,248 @@ class PathGenerator(object):
             ys, ye = ye, ys
         return xs, ys, xe, ye
         
-    def generatePathsForLayer(self, layer, addCleanup = False):
-        paths = {}
-        drills = []
+    # Unmirrored view at reference_scale, see generateReferencePaths
+    def referenceView(self):
+        view = ViewParams()
+        view.board = self.view.board
+        view.scale = self.reference_scale
+        view.cur_layer = None
+        return view
+
+    # Same as generatePathsForLayer, but independent of the current zoom and
+    # mirroring; referenceTransform() maps the result to the current view
+    def generateReferencePaths(self, layer):
+        return type(self)(self.referenceView(), self.milling_params).generatePathsForLayer(layer, addCleanup = True)
+
+    def referenceTransform(self):
+        s = self.view.scale / self.reference_scale
+        sx, sy, dx, dy = s, s, 0.0, 0.0
+        if self.view.is_mirrored():
+            sx = -s
+            dx = (self.sizer.maxpt[0] - self.sizer.minpt[0]) * self.view.scale
+        if self.view.is_ymirrored():
+            sy = -s
+            dy = (self.sizer.maxpt[1] - self.sizer.minpt[1]) * self.view.scale
+        return QtGui.QTransform(sx, 0, 0, sy, dx, dy)
+
+    # Inverse of mapPoint, from view coordinates back to board coordinates
+    def unmapPoint(self, x, y):
+        x /= self.view.scale
+        y /= self.view.scale
+        if self.view.is_mirrored():
+            x = self.sizer.maxpt[0] - x
+        else:
+            x = x + self.sizer.minpt[0]
+        if self.view.is_ymirrored():
+            y = self.sizer.maxpt[1] - y
+        else:
+            y = y + self.sizer.minpt[1]
+        return (x, y)
+
+    # If region (minx, miny, maxx, maxy in board units) is specified, only the
+    # primitives touching it are considered (used for re-milling a region; the
+    # preview builds the whole layer once and keeps it in a GeometryCache)
+    def generatePathsForLayer(self, layer, addCleanup = False, region = None):
         if self.view.board is None:
             return
         layer = self.view.board.layers[layer]
-        for seg in layer.segments:
-            
-            path = QtGui.QPainterPath()
-            lastPt = self.mapPoint(*seg.start)
-            curPt = self.mapPoint(*seg.end)
-            self.addTrackToPath(path, lastPt, curPt, seg.width + self.milling_params.tool_width)
-            #qp.drawPath(path)
-            #path.setFillRule(1)
-            if seg.net in paths:
-                path = paths[seg.net].united(path)
-            paths[seg.net] = path
-        for pad in layer.pads:
-            path = QtGui.QPainterPath()
-            path.setFillRule(1)
-            w = (pad.w + self.milling_params.tool_width) / 2.0
-            h = (pad.h + self.milling_params.tool_width) / 2.0
+        nets, drills = self.collectNetPrimitives(layer, region)
+        paths = self.generateNetPaths(nets)
+        if self.milling_params.total_isolation_passes() > 1:
+            if addCleanup:
+                # Shows what is left after the last pass
+                paths['cleanup'] = self.generateRest(self.generateIsolationPasses(paths)[-1])
+        elif self.milling_params.doubleIsolation:
+            paths['cleanup'] = self.generateCleanup(paths)
+
+        return paths, drills
+
+    # Area outside of the isolation paths widened by another tool width
+    def generateCleanup(self, paths):
+        stroker = QtGui.QPainterPathStroker()
+        stroker.setWidth(self.view.scale * self.milling_params.tool_width)
+        allpathlist = []
+        for p in list(paths.values()):
+            ps = p.united(stroker.createStroke(p))
+            allpathlist.append(ps)
+        allpath = unite_pairwise(allpathlist)
+        
+        #allpath2.subtracted(allpath)
+        allpath3 = QtGui.QPainterPath()
+        allpath3.addRect(*self.getArea())
+        allpath4 = allpath3.subtracted(allpath)
+        return allpath4
+        
+    # Shapely shapes whose outlines are the extra isolation passes (to be clipped to
+    # the board area): the area not covered by the nets, united once over a
+    # rectangle large enough for its edges to stay outside of the board,
+    # shrunk by one more stepover for every pass. Between nets closer than
+    # that, nothing is left to mill. The offsets are done with shapely, as
+    # QPainterPath boolean operations on paths covering the whole board are
+    # much slower.
+    def generateIsolationPasses(self, paths):
+        step = self.view.scale * self.milling_params.tool_width * self.milling_params.isolation_stepover
+        passes = self.milling_params.total_isolation_passes()
+        margin = (passes + 1) * step
+        xs, ys, xe, ye = self.getArea()
+        area = shapely.geometry.box(min(xs, xe) - margin, min(ys, ye) - margin, max(xs, xe) + margin, max(ys, ye) + margin)
+        rest = area.difference(shapely.ops.unary_union([self.pathToShape(p) for p in paths.values()]))
+        return [rest.buffer(-i * step, ShapelyPathGenerator.resolution) for i in range(1, passes)]
+
+    # Shapely geometry with the same area as the path (odd-even filled)
+    def pathToShape(self, path):
+        rings = []
+        for poly in path.simplified().toSubpathPolygons():
+            if len(poly) > 3:
+                rings.append(shapely.geometry.Polygon([(pt.x(), pt.y()) for pt in poly]).buffer(0))
+        return xor_pairwise(rings)
+
+    def shapeToPath(self, shape):
+        path = QtGui.QPainterPath()
+        for poly in getattr(shape, 'geoms', [shape]):
+            if poly.is_empty or not isinstance(poly, shapely.geometry.Polygon):
+                continue
+            for ring in [poly.exterior] + list(poly.interiors):
+                path.addPolygon(QtGui.QPolygonF([QtCore.QPointF(x, y) for x, y in ring.coords]))
+                path.closeSubpath()
+        return path
+
+    # Contours of a shapely shape in view units, as lists of points in board units
+    def shapeToContours(self, shape):
+        contours = []
+        for poly in getattr(shape, 'geoms', [shape]):
+            if poly.is_empty or not isinstance(poly, shapely.geometry.Polygon):
+                continue
+            for ring in [poly.exterior] + list(poly.interiors):
+                contours.append([(x / self.view.scale, y / self.view.scale) for x, y in ring.coords])
+        return contours
+
+    # Area of the board inside of the given pass shape, as a path
+    def generateRest(self, shape):
+        xs, ys, xe, ye = self.getArea()
+        return self.shapeToPath(shapely.geometry.box(min(xs, xe), min(ys, ye), max(xs, xe), max(ys, ye)).intersection(shape))
+
+    # Maps all the primitives to view coordinates and groups them by net,
+    # keeping the order in which nets and primitives are encountered
+    def collectNetPrimitives(self, layer, region = None):
+        nets = {}
+        tool_width = self.milling_params.tool_width
+        segments, pads, polygons = layer.segments, layer.pads, layer.polygons
+        if region is not None:
+            found = layer.get_index().query(region, tool_width)
+            segments = [layer.segments[i] for i in found.segments]
+            pads = [layer.pads[i] for i in found.pads]
+            polygons = {}
+            for net, i in found.polygons:
+                polygons.setdefault(net, []).append(layer.polygons[net][i])
+        for seg in segments:
+            nets.setdefault(seg.net, []).append(('track', self.mapPoint(*seg.start), self.mapPoint(*seg.end), seg.width + tool_width))
+        for pad in pads:
+            w = (pad.w + tool_width) / 2.0
+            h = (pad.h + tool_width) / 2.0
             sx, sy = self.mapPoint(pad.x - w, pad.y - h)
             ex, ey = self.mapPoint(pad.x + w, pad.y + h)
-            if pad.pad_type != 'np_thru_hole':
-                if pad.shape == 'rect':
+            nets.setdefault(pad.net, []).append(('pad', pad.shape, pad.pad_type, sx, sy, ex, ey))
+        drills = self.collectDrills(pads)
+        for net, netpolygons in list(polygons.items()):
+            for p in netpolygons:
+                nets.setdefault(net, []).append(('zone', [self.mapPoint(*pt) for pt in p]))
+        return nets, drills
+
+    # Holes and slots of the pads as (x, y, drillx, drilly, net) in board units
+    def collectDrills(self, pads):
+        drills = []
+        for pad in pads:
+            if pad.pad_type in ('thru_hole', 'np_thru_hole') and pad.drillx > 0 and pad.drilly > 0:
+                drills.append((pad.x, pad.y, pad.drillx, pad.drilly, pad.net))
+        return drills
+
+    def primitiveToPath(self, prim):
+        path = QtGui.QPainterPath()
+        if prim[0] == 'track':
+            self.addTrackToPath(path, prim[1], prim[2], prim[3])
+        elif prim[0] == 'pad':
+            shape, pad_type, sx, sy, ex, ey = prim[1:]
+            path.setFillRule(1)
+            if pad_type != 'np_thru_hole':
+                if shape == 'rect':
                     path.addRect(min(sx, ex), min(sy, ey), abs(ex - sx), abs(ey - sy))
-                elif pad.shape == 'oval':
+                elif shape == 'oval':
                     r = min(abs(ex - sx) / 2.0, abs(ey - sy) / 2.0)
                     path.addRoundedRect(min(sx, ex), min(sy, ey), abs(ex - sx), abs(ey - sy), r, r)
-                elif pad.shape == 'circle':
+                elif shape == 'circle':
                     wh = min(abs(ex - sx), abs(ey - sy))
                     path.addEllipse(min(sx, ex), min(sy, ey), wh - 1, wh - 1)
-            if pad.pad_type in ('thru_hole', 'np_thru_hole') and pad.drillx > 0 and pad.drilly > 0:
-                drills.append((pad.x, pad.y, pad.drillx, pad.drilly, pad.net))
-            if pad.net in paths:
-                path = paths[pad.net].united(path)
-            paths[pad.net] = path
-        #pen.setWidth(0)
-        #qp.setPen(pen)
-        #qp.setBrush(QtGui.QColor(200, 0, 0))
-        for net, polygons in list(layer.polygons.items()):
-            for p in polygons:
-                path = QtGui.QPainterPath()
-                path.setFillRule(1)
-                path.moveTo(*self.mapPoint(*p[0]))
-                for pt in p[1:]:
-                    path.lineTo(*self.mapPoint(*pt))
-                path.lineTo(*self.mapPoint(*p[0]))
-                path.closeSubpath()
-                
-                path3 = QtGui.QPainterPathStroker()
-                path3.setWidth(self.view.scale * self.milling_params.tool_width)
-                path3 = path3.createStroke(path).simplified()
-
-                path = path.united(path3)
-                if net in paths:
-                    path = paths[net].united(path)
-                paths[net] = path
-        if self.milling_params.doubleIsolation:
-            allpath = QtGui.QPainterPath()
-            stroker = QtGui.QPainterPathStroker()
-            stroker.setWidth(self.view.scale * self.milling_params.tool_width)
-            allpathlist = []
-            for p in list(paths.values()):
-                ps = p.united(stroker.createStroke(p))
-                allpathlist.append(ps)
-            while len(allpathlist) > 1:
-                p1 = allpathlist[0]
-                p2 = allpathlist[1]
-                allpathlist = allpathlist[2:] + [p1.united(p2)]
-            allpath = allpathlist[0]
+        elif prim[0] == 'zone':
+            pts = prim[1]
+            path.setFillRule(1)
+            path.moveTo(*pts[0])
+            for pt in pts[1:]:
+                path.lineTo(*pt)
+            path.lineTo(*pts[0])
+            path.closeSubpath()
             
-            #allpath2.subtracted(allpath)
-            allpath3 = QtGui.QPainterPath()
-            allpath3.addRect(*self.getArea())
-            allpath4 = allpath3.subtracted(allpath)
-            paths['cleanup'] = allpath4
+            path3 = QtGui.QPainterPathStroker()
+            path3.setWidth(self.view.scale * self.milling_params.tool_width)
+            path3 = path3.createStroke(path).simplified()
+
+            path = path.united(path3)
+        return path
+
+    def generateNetPath(self, primitives):
+        if self.milling_params.union_strategy == 'pairwise':
+            return unite_pairwise([self.primitiveToPath(prim) for prim in primitives])
+        path = None
+        for prim in primitives:
+            if path is None:
+                path = self.primitiveToPath(prim)
+            else:
+                path = path.united(self.primitiveToPath(prim))
+        return path
+
+    def generateNetPaths(self, nets):
+        processes = self.milling_params.processes
+        if processes == 1 or len(nets) < 2:
+            return {net : self.generateNetPath(primitives) for net, primitives in nets.items()}
+        # Nets are independent, so build them in separate processes, biggest
+        # ones first, and then put them back into the original order
+        tasks = [(type(self), self.view.scale, self.milling_params, net, primitives) for net, primitives in nets.items()]
+        tasks.sort(key = lambda task: -sum(len(prim[1]) if prim[0] == 'zone' else 1 for prim in task[4]))
+        pool = multiprocessing.Pool(processes or None)
+        try:
+            results = dict(pool.imap_unordered(_net_path_worker, tasks))
+        finally:
+            pool.close()
+            pool.join()
+        return {net : self.deserializePath(results[net]) for net in nets}
+
+    def serializePath(self, path):
+        return path_to_bytes(path)
+
+    def deserializePath(self, data):
+        return path_from_bytes(data)
+
+    # Nets whose primitives are near the point given in view coordinates
+    def netsNearPoint(self, layer, x, y):
+        bx, by = self.unmapPoint(x, y)
+        layer = self.view.board.layers[layer]
+        found = layer.get_index().query((bx, by, bx, by), self.milling_params.tool_width)
+        nets = set()
+        nets.update(layer.segments[i].net for i in found.segments)
+        nets.update(layer.pads[i].net for i in found.pads)
+        nets.update(net for net, i in found.polygons)
+        return nets
+
+    # Outlines of a generated path as lists of points in board units
+    def pathToContours(self, path):
+        contours = []
+        for poly in path.simplified().toSubpathPolygons():
+            pts = []
+            for pt in poly:
+                pts.append((pt.x() / self.view.scale, pt.y() / self.view.scale))
+            contours.append(pts)
+        return contours
 
-        return paths, drills
-        
     def addTrackToPath(self, path, lastPt, curPt, width):
         w = self.view.scale * width / 2
         angle = math.atan2(curPt[1] - lastPt[1], curPt[0] - lastPt[0])
@@ -183,30 +378,236 @@ class PathGenerator(object):
         v = addvec(lastPt, (-w, -w))
         path.arcTo(v[0], v[1], 2 * w, 2 * w, -angledeg+90, 180)
         
+# Same geometry as PathGenerator, but computed with shapely/GEOS. Net outlines
+# are shapely geometries in view units instead of QPainterPaths, so this
+# works without any Qt objects (but cannot be used by PathPreview).
+class ShapelyPathGenerator(PathGenerator):
+    resolution = 8
+
+    def primitiveToPath(self, prim):
+        if prim[0] == 'track':
+            p1, p2, width = prim[1:]
+            if p1 == p2:
+                return shapely.geometry.Point(p1).buffer(self.view.scale * width / 2, self.resolution)
+            return shapely.geometry.LineString([p1, p2]).buffer(self.view.scale * width / 2, self.resolution)
+        elif prim[0] == 'pad':
+            shape, pad_type, sx, sy, ex, ey = prim[1:]
+            if pad_type != 'np_thru_hole':
+                x1, y1, x2, y2 = min(sx, ex), min(sy, ey), max(sx, ex), max(sy, ey)
+                if shape == 'rect':
+                    return shapely.geometry.box(x1, y1, x2, y2)
+                elif shape == 'oval':
+                    r = min(x2 - x1, y2 - y1) / 2.0
+                    return shapely.geometry.box(x1 + r, y1 + r, x2 - r, y2 - r).buffer(r, self.resolution)
+                elif shape == 'circle':
+                    # Same size and placement as the QPainterPath ellipse
+                    r = (min(x2 - x1, y2 - y1) - 1) / 2.0
+                    return shapely.geometry.Point(x1 + r, y1 + r).buffer(r, self.resolution)
+            return shapely.geometry.Polygon()
+        elif prim[0] == 'zone':
+            poly = shapely.geometry.Polygon(prim[1])
+            if not poly.is_valid:
+                poly = poly.buffer(0)
+            return poly.buffer(self.view.scale * self.milling_params.tool_width / 2, self.resolution)
+
+    def generateNetPath(self, primitives):
+        return shapely.ops.unary_union([self.primitiveToPath(prim) for prim in primitives])
+
+    def generateCleanup(self, paths):
+        allpath = shapely.ops.unary_union([p.buffer(self.view.scale * self.milling_params.tool_width / 2, self.resolution) for p in paths.values()])
+        xs, ys, xe, ye = self.getArea()
+        return shapely.geometry.box(min(xs, xe), min(ys, ye), max(xs, xe), max(ys, ye)).difference(allpath)
+
+    def pathToShape(self, path):
+        return path
+
+    def shapeToPath(self, shape):
+        return shape
+
+    def serializePath(self, path):
+        return shapely.wkb.dumps(path)
+
+    def deserializePath(self, data):
+        return shapely.wkb.loads(data)
+
+    def pathToContours(self, path):
+        return self.shapeToContours(path)
+
+def make_path_generator(view, milling_params):
+    if milling_params.backend == 'shapely':
+        return ShapelyPathGenerator(view, milling_params)
+    return PathGenerator(view, milling_params)
+
+# LRU cache of reference geometry (see PathGenerator.generateReferencePaths)
+# keyed by the board contents, layer and the milling parameters that affect
+# the shape.
+# The size of the entries is estimated from the number of path elements.
+class GeometryCache(object):
+    element_size = 40
+
+    def __init__(self, budget = 256 * 1048576):
+        self.budget = budget
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    def get(self, pathgen, layer):
+        board = pathgen.view.board
+        params = pathgen.milling_params
+        key = (board.digest, layer, board.layers[layer].change_key(), params.tool_width, params.doubleIsolation, params.isolation_passes, params.isolation_stepover, type(pathgen))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+        result = pathgen.generateReferencePaths(layer)
+        size = sum(path.elementCount() * self.element_size for path in result[0].values())
+        self.entries[key] = (result, size)
+        self.size += size
+        while self.size > self.budget and len(self.entries) > 1:
+            oldkey, (oldresult, oldsize) = self.entries.popitem(last = False)
+            self.size -= oldsize
+        return result
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+def path_to_bytes(path):
+    data = QtCore.QByteArray()
+    stream = QtCore.QDataStream(data, QtCore.QIODevice.WriteOnly)
+    stream << path
+    return bytes(data)
+
+def path_from_bytes(data):
+    path = QtGui.QPainterPath()
+    stream = QtCore.QDataStream(QtCore.QByteArray(data))
+    stream >> path
+    return path
+
+def _net_path_worker(task):
+    generator_class, scale, milling_params, net, primitives = task
+    view = ViewParams()
+    view.scale = scale
+    pp = generator_class(view, milling_params)
+    return net, pp.serializePath(pp.generateNetPath(primitives))
+
+# Symmetric difference of the shapely shapes (odd-even fill), combined in
+# pairs the same way as unite_pairwise
+def xor_pairwise(shapes):
+    queue = collections.deque(shapes)
+    while len(queue) > 1:
+        queue.append(queue.popleft().symmetric_difference(queue.popleft()))
+    return queue[0] if queue else shapely.geometry.Polygon()
+
+# Unites the paths in pairs, level by level, so that each union works on
+# similarly sized operands instead of one ever-growing accumulated path
+def unite_pairwise(pathlist):
+    queue = collections.deque(pathlist)
+    while len(queue) > 1:
+        p1 = queue.popleft()
+        p2 = queue.popleft()
+        queue.append(p1.united(p2))
+    return queue[0] if queue else None
+
+# Grid of points for nearest neighbour queries. Every point belongs to a
+# group (e.g. a path), and whole groups can be removed. Ties between equally
+# distant points are resolved using the per-point sort key.
+class PointIndex(object):
+    def __init__(self, points, cell_size = None):
+        # points: list of (x, y, group, key)
+        self.count = len(points)
+        self.cells = {}
+        self.group_cells = {}
+        if not points:
+            self.cell_size = 1.0
+            self.limits = (0, 0, 0, 0)
+            return
+        xs = [pt[0] for pt in points]
+        ys = [pt[1] for pt in points]
+        if cell_size is None:
+            area = max(max(xs) - min(xs), 1e-3) * max(max(ys) - min(ys), 1e-3)
+            cell_size = max((area * 4.0 / len(points)) ** 0.5, 1e-3)
+        self.cell_size = cell_size
+        cells = self.cells
+        for pt in points:
+            cell = (int(math.floor(pt[0] / cell_size)), int(math.floor(pt[1] / cell_size)))
+            if cell in cells:
+                cells[cell].append(pt)
+            else:
+                cells[cell] = [pt]
+            self.group_cells.setdefault(pt[2], set()).add(cell)
+        cx = [c[0] for c in cells]
+        cy = [c[1] for c in cells]
+        self.limits = (min(cx), min(cy), max(cx), max(cy))
+
+    def __len__(self):
+        return self.count
+
+    def remove_group(self, group):
+        for cell in self.group_cells.pop(group, ()):
+            pts = self.cells[cell]
+            kept = [pt for pt in pts if pt[2] != group]
+            self.count -= len(pts) - len(kept)
+            if kept:
+                self.cells[cell] = kept
+            else:
+                del self.cells[cell]
+
+    # Returns (dist2, key, point) of the nearest point, or None if empty
+    def nearest(self, x, y):
+        if not self.count:
+            return None
+        cs = self.cell_size
+        qx, qy = int(math.floor(x / cs)), int(math.floor(y / cs))
+        minx, miny, maxx, maxy = self.limits
+        maxring = max(qx - minx, maxx - qx, qy - miny, maxy - qy)
+        best = None
+        ring = 0
+        while ring <= maxring:
+            if best is not None and best[0] < ((ring - 1) * cs) ** 2:
+                break
+            if 8 * ring > self.count:
+                # Cheaper to look at the remaining points than at the cells
+                return self.nearestOf(x, y, [pt for pts in self.cells.values() for pt in pts], best)
+            best = self.nearestOf(x, y, self.ringPoints(qx, qy, ring), best)
+            ring += 1
+        return best
+
+    def ringPoints(self, qx, qy, ring):
+        cells = self.cells
+        if ring == 0:
+            return cells.get((qx, qy), ())
+        pts = []
+        for cx in range(qx - ring, qx + ring + 1):
+            for cy in (qy - ring, qy + ring):
+                if (cx, cy) in cells:
+                    pts += cells[(cx, cy)]
+        for cy in range(qy - ring + 1, qy + ring):
+            for cx in (qx - ring, qx + ring):
+                if (cx, cy) in cells:
+                    pts += cells[(cx, cy)]
+        return pts
+
+    @staticmethod
+    def nearestOf(x, y, pts, best):
+        for pt in pts:
+            dist2 = (pt[0] - x)**2 + (pt[1] - y)**2
+            if best is None or dist2 < best[0] or (dist2 == best[0] and pt[3] < best[1]):
+                best = (dist2, pt[3], pt)
+        return best
+
 def optimize_paths(paths):
-    # Minimize the rapids (using some crappy greedy optimisation algorithm)
+    # Minimize the rapids (greedy nearest neighbour, using a grid of all the
+    # path points to find the closest entry point)
     newpaths = paths[0:1]
-    paths = paths[1:]
-    while len(paths) > 0:
+    index = PointIndex([(pt[0], pt[1], p, (p, ptidx)) for p in range(1, len(paths)) for ptidx, pt in enumerate(paths[p])])
+    while len(index):
         lastpt = newpaths[-1][-1]
-        pt = paths[0][0]
-        mindist2 = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
-        minp = 0
-        minpt = 0
-        for p in range(len(paths)):
-            for ptidx in range(0, len(paths[p])):
-                pt = paths[p][ptidx]
-                dist2 = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
-                if dist2 < mindist2:
-                    mindist2 = dist2
-                    minpt = ptidx
-                    minp = p
+        dist2, (minp, minpt), pt = index.nearest(lastpt[0], lastpt[1])
+        index.remove_group(minp)
         p = paths[minp]
         if minpt > 0:
             newpaths.append(p[minpt:] + p[:minpt])
         else:
             newpaths.append(p)
-        paths[minp:minp + 1] = []
     return newpaths
 
 def _convpt(pt, view, sizer):
@@ -241,6 +642,17 @@ class EdgeCuttingOperation:
     feed = 500
     plunge = 500
 
+# Roughing out the copper left between the isolation paths with an endmill
+class ClearingOperation:
+    endmill_dia = 1.0
+    zsafe = 0.8
+    zend = 30
+    zsurface = 0
+    zstep = 0.1
+    zdepth = -0.1
+    feed = 600
+    plunge = 300
+
 class PeckDrillingOperation:
     endmill_dia = 0.8
     zsurface = 0
@@ -304,89 +716,245 @@ def profile_mill(gc, xs, ys, xe, ye, reqdia, operation):
                 radius = (reqdia - endmill_dia) / 2.0
     gc.get_safe()
 
-def cmpguess(g1, g2, tol = 0.02, stol = 0.1):
-    if g1 is None or g2 is None:
-        return False
-    c1, r1, s1 = g1
-    c2, r2, s2 = g2
-    d = QtCore.QLineF(c1, c2)
-    if d.length() > tol:
-        return False
-    dr = abs(r1 - r2)
-    if dr > tol:
-        return False
-    if max(s1, s2) > max(stol, 2 * math.pi * max(r1, r2) / 5):
-        return False
-    return True
+# Circumcentre guesses for each three consecutive points (i, i + 1, i + 2),
+# as arrays of centre x and y, radius, longer side and validity. Computed
+# the same way as with QLineF normal vector intersections.
+def arc_guesses(points):
+    p = numpy.asarray(points, dtype = float).reshape(-1, 2)
+    n = len(p)
+    cx, cy, r, step = numpy.zeros(n), numpy.zeros(n), numpy.zeros(n), numpy.zeros(n)
+    valid = numpy.zeros(n, dtype = bool)
+    if n < 3:
+        return cx, cy, r, step, valid
+    p1, p2, p3 = p[:-2], p[1:-1], p[2:]
+    d1, d2 = p2 - p1, p3 - p2
+    # Perpendicular bisectors from m to e
+    m1, m2 = p1 + d1 / 2, p2 + d2 / 2
+    e1 = (p1 + numpy.column_stack([d1[:, 1], -d1[:, 0]])) + d1 / 2
+    e2 = (p2 + numpy.column_stack([d2[:, 1], -d2[:, 0]])) + d2 / 2
+    a, b, c = e1 - m1, m2 - e2, m1 - m2
+    den = a[:, 1] * b[:, 0] - a[:, 0] * b[:, 1]
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        na = (b[:, 1] * c[:, 0] - b[:, 0] * c[:, 1]) * (1 / den)
+        centre = m1 + a * na[:, None]
+        dc = centre - p1
+        radius = numpy.sqrt(dc[:, 0] * dc[:, 0] + dc[:, 1] * dc[:, 1])
+    l1 = numpy.sqrt(d1[:, 0] * d1[:, 0] + d1[:, 1] * d1[:, 1])
+    l2 = numpy.sqrt(d2[:, 0] * d2[:, 0] + d2[:, 1] * d2[:, 1])
+    ok = (den != 0) & numpy.isfinite(den) & (radius > 0.1)
+    centre[~ok] = 0
+    radius[~ok] = 0
+    cx[:-2], cy[:-2], r[:-2], step[:-2], valid[:-2] = centre[:, 0], centre[:, 1], radius, numpy.maximum(l1, l2), ok
+    return cx, cy, r, step, valid
+
+# Whether guess k matches each of the guesses in others (an index array or slice)
+def guesses_match(guesses, k, others, tol = 0.02, stol = 0.1):
+    cx, cy, r, step, valid = guesses
+    dx, dy = cx[others] - cx[k], cy[others] - cy[k]
+    return valid[k] & valid[others] & \
+        (numpy.sqrt(dx * dx + dy * dy) <= tol) & \
+        (numpy.abs(r[k] - r[others]) <= tol) & \
+        (numpy.maximum(step[k], step[others]) <= numpy.maximum(stol, 2 * math.pi * numpy.maximum(r[k], r[others]) / 5))
 
 def calign(pt, cx, cy, r):
     x, y = pt
     angle = math.atan2(y - cy, x - cx)
     return (cx + r * math.cos(angle), cy + r * math.sin(angle))
 
-def path_to_optimized_gcode(gc, points):
-    guesses = []
-    for i in range(len(points)):
-        if i + 2 >= len(points):
-            guesses.append(None)
-            continue
-        p1 = QtCore.QPointF(*points[i])
-        p2 = QtCore.QPointF(*points[i + 1])
-        p3 = QtCore.QPointF(*points[i + 2])
-        l1 = QtCore.QLineF(p1, p2)
-        l2 = QtCore.QLineF(p2, p3)
-        n1 = l1.normalVector().translated(l1.dx() / 2, l1.dy() / 2)
-        n2 = l2.normalVector().translated(l2.dx() / 2, l2.dy() / 2)
-        centre = QtCore.QPointF(0, 0)
-        if n1.intersect(n2, centre) > 0:
-            r = QtCore.QLineF(p1, centre).length()
-            step = max(l1.length(), l2.length())
-            if r > 0.1:
-                guesses.append((centre, r, step))
+# Fits clockwise arcs to the runs of points lying on the same circle (within
+# tol). Returns the moves along each contour: ('move', x, y), ('line', x, y)
+# and ('arc', x, y, i, j), so that they can be reused for every depth. The
+# guesses for all the contours are computed in one go.
+def fit_arcs_many(contours, closed = True, tol = 0.02, stol = 0.1):
+    contours = [p for p in contours if len(p)]
+    if not contours:
+        return []
+    guesses = arc_guesses([pt for p in contours for pt in p])
+    offsets = [0]
+    for p in contours:
+        offsets.append(offsets[-1] + len(p))
+    # The last two guesses of each contour include points of the next one
+    valid = guesses[4]
+    for o in offsets[1:]:
+        valid[max(o - 2, 0):o] = False
+    total = offsets[-1]
+    # adjacent[k]: guesses k and k + 1 match
+    adjacent = guesses_match(guesses, slice(0, total - 1), slice(1, total), tol, stol).tolist()
+    cx, cy, r = guesses[0].tolist(), guesses[1].tolist(), guesses[2].tolist()
+    result = []
+    for p, o in zip(contours, offsets):
+        n = len(p)
+        moves = [('move', p[0][0], p[0][1])]
+        i = 1
+        while i < n:
+            if i + 1 < n and adjacent[o + i - 1]:
+                # Extend the run while the guesses match the first one
+                j = i
+                window = 16
+                while True:
+                    matches = guesses_match(guesses, o + i - 1, slice(o + j + 1, o + min(j + 1 + window, n)), tol, stol)
+                    failed = numpy.flatnonzero(~matches)
+                    if len(failed):
+                        j += int(failed[0])
+                        break
+                    j += len(matches)
+                    if j + 1 >= n:
+                        break
+                    window *= 2
+                # (i - 1, i, i + 1) =~ ... =~ (j, j + 1, j + 2)
+                acx = sum(cx[o + i - 1:o + j]) / (j - i + 1)
+                acy = sum(cy[o + i - 1:o + j]) / (j - i + 1)
+                ar = sum(r[o + i - 1:o + j]) / (j - i + 1)
+                start = calign(p[i - 1], acx, acy, ar)
+                end = calign(p[j + 2], acx, acy, ar)
+                moves.append(('arc', end[0], end[1], acx - start[0], acy - start[1]))
+                i = j + 3
             else:
-                guesses.append(None)
+                moves.append(('line', p[i][0], p[i][1]))
+                i += 1
+        if closed:
+            moves.append(('line', p[0][0], p[0][1]))
+        result.append(moves)
+    return result
+
+def fit_arcs(points, closed = True, tol = 0.02, stol = 0.1):
+    return fit_arcs_many([points], closed, tol, stol)[0]
+
+# Simplifies the runs of line moves between the arcs fitted by fit_arcs
+def simplify_moves(moves, tolerance):
+    result = []
+    run = []
+    def flush():
+        for x, y in simplify_polyline(run, tolerance)[1:]:
+            result.append(('line', x, y))
+    for m in moves:
+        if m[0] == 'line' and result:
+            if not run:
+                run.append(result[-1][1:3])
+            run.append(m[1:3])
         else:
-            guesses.append(None)
-    gc.move_to(points[0][0], points[0][1])
-    i = 1
-    while i < len(points):
-        p = points[i]
-        if i + 1 < len(points) and cmpguess(guesses[i - 1], guesses[i]):
-            j = i
-            while j < len(points) and cmpguess(guesses[i - 1], guesses[j + 1]):
-                j += 1
-            # (i - 1, i, i + 1) =~ ... =~ (j, j + 1, j + 2)
-            cx = sum([guesses[k][0].x() for k in range(i - 1, j)]) / (j - i + 1)
-            cy = sum([guesses[k][0].y() for k in range(i - 1, j)]) / (j - i + 1)
-            r = sum([guesses[k][1] for k in range(i - 1, j)]) / (j - i + 1)
-            start = calign(points[i - 1], cx, cy, r)
-            end = calign(points[j + 2], cx, cy, r)
-            gc.arc_cw_to(x = end[0], y = end[1], i = cx - start[0], j = cy - start[1])
-            #print "G2 X%0.4f Y%0.4f I%0.4f J%0.4f" % (end[0], end[1], cx - start[0], cy - start[1])
-            #print "Arc to: %s centre: %s" % (points[j], (cx, cy))
-            i = j + 3
+            if run:
+                flush()
+                run = []
+            result.append(m)
+    if run:
+        flush()
+    return result
+
+def emit_moves(gc, moves):
+    for m in moves:
+        if m[0] == 'line':
+            gc.line_to(m[1], m[2])
+        elif m[0] == 'arc':
+            gc.arc_cw_to(x = m[1], y = m[2], i = m[3], j = m[4])
         else:
-            gc.line_to(points[i][0], points[i][1])
-            i += 1
-    gc.line_to(points[0][0], points[0][1])
+            gc.move_to(m[1], m[2])
 
-def mill_contours(gc, board, layer, milling_params):
-    operation = gc.operation
+def path_to_optimized_gcode(gc, points, closed = True):
+    emit_moves(gc, fit_arcs(points, closed))
+
+# Cuts the contours down to the part inside a rectangle (in the same
+# coordinates as the contours). Returns the contours that are entirely
+# inside, and the open pieces of the ones crossing the boundary.
+def clip_contours(contours, rect):
+    box = shapely.geometry.box(*rect)
+    closed = []
+    pieces = []
+    for c in contours:
+        line = shapely.geometry.LineString(c)
+        if box.contains(line):
+            closed.append(c)
+        elif box.intersects(line):
+            clipped = line.intersection(box)
+            if isinstance(clipped, shapely.geometry.MultiLineString):
+                clipped = shapely.ops.linemerge(clipped)
+            for piece in getattr(clipped, 'geoms', [clipped]):
+                if isinstance(piece, shapely.geometry.LineString) and not piece.is_empty:
+                    pieces.append(list(piece.coords))
+    return closed, pieces
+
+def isolation_view(board, layer = None):
     view = ViewParams(ymirror = True)
     view.board = board
     view.scale = 10.0
-    gcodefile = "paths.nc"
-    pp = PathGenerator(view, milling_params)
-    paths, drills = pp.generatePathsForLayer(layer)
+    if layer is not None:
+        view.cur_layer = layer
+    return view
+
+# Key identifying a toolpath computation in a ToolpathCache
+def toolpath_key(kind, board, layer, milling_params, *extra):
+    return (kind, board.digest, layer, milling_params.tool_width, milling_params.doubleIsolation, milling_params.isolation_passes, milling_params.isolation_stepover, milling_params.backend, milling_params.tour_time, milling_params.group_holes) + extra
+
+# Runs the tour improvement on the greedy ordering if enabled in milling_params;
+# returns the new order as (index, reversed) pairs. The rapid distances before
+# and after the improvement are added to rapids, if given.
+def improve_order(entries, exits, milling_params, reversible = False, start = (0, 0), rapids = None):
+    if not milling_params.tour_time:
+        return [(i, False) for i in range(len(entries))]
+    order, before, after = improve_tour(start, entries, exits, milling_params.tour_time, reversible)
+    if rapids is not None:
+        rapids[0] += before
+        rapids[1] += after
+    return order
+
+# Toolpaths computed by compute(rapids) or taken from the cache, with the
+# rapid distances from improve_order counted in gc
+def cached_toolpaths(gc, cache, key, compute):
+    def compute_with_rapids():
+        rapids = [0.0, 0.0]
+        return compute(rapids), rapids
+    value, rapids = cached_value(cache, key, compute_with_rapids)
+    gc.count_rapids(*rapids)
+    return value
+
+# Ordered isolation contours, as (closed contours, open polylines)
+def contour_toolpaths(board, layer, milling_params, region = None, rapids = None):
+    view = isolation_view(board, layer)
+    pp = make_path_generator(view, milling_params)
+    paths, drills = pp.generatePathsForLayer(layer, region = region)
     pathlist = []
     for net, path in list(paths.items()):
-        for poly in path.simplified().toSubpathPolygons():
-            pts = []
-            for pt in poly:
-                pts.append((pt.x() / view.scale, pt.y() / view.scale))
-            pathlist.append(pts)
-    pathlist = optimize_paths(pathlist)
+        pathlist += pp.pathToContours(path)
+    openlist = []
+    if milling_params.total_isolation_passes() > 1:
+        # Extra passes, only within the board
+        xs, ys, xe, ye = [c / view.scale for c in pp.getArea()]
+        area = (min(xs, xe), min(ys, ye), max(xs, xe), max(ys, ye))
+        for path in pp.generateIsolationPasses(paths):
+            inside, pieces = clip_contours(pp.shapeToContours(path), area)
+            pathlist += inside
+            openlist += pieces
+    if region is not None:
+        xs, ys = pp.mapPoint(region[0], region[1])
+        xe, ye = pp.mapPoint(region[2], region[3])
+        xs, ys, xe, ye = xs / view.scale, ys / view.scale, xe / view.scale, ye / view.scale
+        rect = (min(xs, xe), min(ys, ye), max(xs, xe), max(ys, ye))
+        # Open pieces stay open whether they are cut again or not
+        inside, cut = clip_contours(openlist, rect)
+        pathlist, openlist = clip_contours(pathlist, rect)
+        openlist += inside + cut
+    if pathlist:
+        pathlist = optimize_paths(pathlist)
+        # The contours are closed back to their first point
+        starts = [p[0] for p in pathlist]
+        pathlist = [pathlist[i] for i, rev in improve_order(starts, starts, milling_params, rapids = rapids)]
+    return pathlist, openlist
+
+# With region (minx, miny, maxx, maxy in board units), only the isolation
+# paths inside that rectangle are milled, e.g. to re-mill an underetched area
+def mill_contours(gc, board, layer, milling_params, region = None, cache = None):
+    operation = gc.operation
+    pathlist, openlist = cached_toolpaths(gc, cache, toolpath_key('contours', board, layer, milling_params, region), lambda rapids: contour_toolpaths(board, layer, milling_params, region, rapids))
     
+    # The arcs are fitted and formatted once, all depths cut the same moves
+    toolpath = Toolpath(gc.grid)
+    tolerance = milling_params.simplify_tolerance
+    for moves in fit_arcs_many(pathlist) + fit_arcs_many(openlist, closed = False):
+        if tolerance > 0:
+            before = len(moves) - 1
+            moves = simplify_moves(moves, tolerance)
+            gc.count_segments(before, len(moves) - 1)
+        emit_moves(toolpath, moves)
     gc.feed = operation.feed
     gc.plunge = operation.plunge
     depth = 0
@@ -396,92 +964,189 @@ def mill_contours(gc, board, layer, milling_params):
             depth = operation.zdepth
         gc.zdepth = depth
         gc.get_safe()
-        for p in pathlist:
-            path_to_optimized_gcode(gc, p)
+        gc.emit_toolpath(toolpath)
 
-def drill_holes_and_slots(gc, board, layer, milling_params):
-    operation = gc.operation
-    view = ViewParams(ymirror = True)
-    view.board = board
-    view.scale = 10.0
-    view.cur_layer = layer
-    pp = PathGenerator(view, milling_params)
-    paths, drills = pp.generatePathsForLayer(layer)
-    all_holes = list(drills)
-    sorted_holes = []
+# Holes and slots in drilling order, as (x, y, drillx, drilly) in machine coordinates
+def hole_toolpaths(board, layer, milling_params, rapids = None):
+    view = isolation_view(board, layer)
+    pp = make_path_generator(view, milling_params)
     sizer = pp.sizer
     def convpt(pt):
         return _convpt(pt, view, sizer)
 
+    holes = [convpt((x, y)) + (drillx, drilly) for x, y, drillx, drilly, net in pp.collectDrills(board.layers[layer].pads)]
+    if milling_params.group_holes:
+        # Smallest holes first, each size ordered separately
+        groups = {}
+        for h in holes:
+            groups.setdefault((h[2], h[3]), []).append(h)
+        groups = [groups[size] for size in sorted(groups, key = lambda size: (min(size), max(size)))]
+    else:
+        groups = [holes]
+    sorted_holes = []
     lastpt = (0, 0)
-    while len(all_holes) > 0:
-        pt = None
-        min_dist = None
-        min_line = None
-        for h in range(len(all_holes)):
-            pt = convpt(all_holes[h][0:2])
-            dist = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
-            if min_dist is None or dist < min_dist:
-                min_hole = h
-                min_dist = dist
-        
-        sorted_holes.append(all_holes[min_hole])
-        lastpt = convpt(all_holes[min_hole][0:2])
-        all_holes = all_holes[:min_hole] + all_holes[min_hole + 1:]
-        
-    for x, y, drillx, drilly, net in sorted_holes:
+    for group in groups:
+        startpt = lastpt
+        index = PointIndex([(h[0], h[1], i, i) for i, h in enumerate(group)])
+        ordered = []
+        while len(index):
+            dist2, i, pt = index.nearest(lastpt[0], lastpt[1])
+            index.remove_group(i)
+            ordered.append(group[i])
+            lastpt = group[i][0:2]
+        centres = [h[0:2] for h in ordered]
+        sorted_holes += [ordered[i] for i, rev in improve_order(centres, centres, milling_params, start = startpt, rapids = rapids)]
+        if sorted_holes:
+            lastpt = sorted_holes[-1][0:2]
+    return sorted_holes
+
+def drill_holes_and_slots(gc, board, layer, milling_params, cache = None):
+    operation = gc.operation
+    sorted_holes = cached_toolpaths(gc, cache, toolpath_key('holes', board, layer, milling_params), lambda rapids: hole_toolpaths(board, layer, milling_params, rapids))
+    for x, y, drillx, drilly in sorted_holes:
         drillx += 0.05
         drilly += 0.05
-        x, y = convpt((x, y))
         if drillx < drilly:
             profile_mill(gc, x, y - (drilly - drillx) / 2.0, x, y + (drilly - drillx) / 2.0, drillx, operation)
         else:
             profile_mill(gc, x - (drillx - drilly) / 2.0, y, x + (drillx - drilly) / 2.0, y, drilly, operation)
     gc.get_safe()
 
-def cut_edges(gc, board, layer, milling_params):
-    view = ViewParams(ymirror = True)
-    view.board = board
-    view.scale = 10.0
-    view.cur_layer = layer
+# Joins lines whose ends are within tolerance into polylines. Returns a list
+# of (points, closed); closed polylines end with their first point.
+def chain_lines(lines, tolerance = 0.01):
+    nodes = []
+    cells = {}
+    def node_at(pt):
+        cx, cy = int(math.floor(pt[0] / tolerance)), int(math.floor(pt[1] / tolerance))
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for n in cells.get((cx + dx, cy + dy), ()):
+                    q = nodes[n]
+                    if (q[0] - pt[0])**2 + (q[1] - pt[1])**2 <= tolerance**2:
+                        return n
+        nodes.append(pt)
+        cells.setdefault((cx, cy), []).append(len(nodes) - 1)
+        return len(nodes) - 1
+
+    edges = []
+    adjacent = collections.defaultdict(list)
+    for start, end in lines:
+        a, b = node_at(start), node_at(end)
+        if a != b:
+            adjacent[a].append(len(edges))
+            adjacent[b].append(len(edges))
+            edges.append((a, b))
+    used = [False] * len(edges)
+    def next_edge(n):
+        adj = adjacent[n]
+        while adj and used[adj[-1]]:
+            adj.pop()
+        return adj[-1] if adj else None
+    def walk(n):
+        chain = [n]
+        e = next_edge(n)
+        while e is not None:
+            used[e] = True
+            a, b = edges[e]
+            n = b if a == n else a
+            chain.append(n)
+            e = next_edge(n)
+        return chain
+
+    chains = []
+    # Open chains start at odd nodes, what remains are closed loops
+    starts = [n for n in range(len(nodes)) if len(adjacent[n]) % 2] + list(range(len(nodes)))
+    for n in starts:
+        while next_edge(n) is not None:
+            chain = walk(n)
+            chains.append(([nodes[i] for i in chain], len(chain) > 2 and chain[0] == chain[-1]))
+    return chains
+
+def polylines_toolpath(grid, polylines):
+    toolpath = Toolpath(grid)
+    for pts in polylines:
+        toolpath.move_to(*pts[0])
+        for pt in pts[1:]:
+            toolpath.line_to(*pt)
+    return toolpath
+
+def edge_toolpaths(board, layer, milling_params, rapids = None):
+    view = isolation_view(board, layer)
     sizer = BoardSizer(board)
     def convpt(pt):
         return _convpt(pt, view, sizer)
 
-    operation = gc.operation
     cuts = board.layers[layer]
-    all_lines = list(cuts.gr_lines)
-    lastpt = (0, 0)
-    
-    sorted_lines = []
-    while len(all_lines) > 0:
-        pt = all_lines[0].start[0]
-        min_dist = None
-        min_line = None
-        for line in range(len(all_lines)):
-            for ptt in ('start', 'end'):
-                pt = convpt(getattr(all_lines[line], ptt))
-                dist = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
-                if min_dist is None or dist < min_dist:
-                    min_line = (line, ptt)
-                    min_dist = dist
-        ml = all_lines[min_line[0]]
-        if min_line[1] == 'start':
-            lastpt = convpt((ml.end[0], ml.end[1]))
-            sorted_lines.append((convpt((ml.start[0], ml.start[1])), lastpt))
+    chains = chain_lines([(convpt(line.start), convpt(line.end)) for line in cuts.gr_lines])
+    # Closed chains may be entered at any point, open ones at either end
+    points = []
+    for c, (pts, closed) in enumerate(chains):
+        if closed:
+            points += [(x, y, c, (c, i)) for i, (x, y) in enumerate(pts[:-1])]
         else:
-            lastpt = convpt((ml.start[0], ml.start[1]))
-            sorted_lines.append((convpt((ml.end[0], ml.end[1])), lastpt))
-        all_lines = all_lines[:min_line[0]] + all_lines[min_line[0] + 1:]
+            points += [(pts[0][0], pts[0][1], c, (c, 0)), (pts[-1][0], pts[-1][1], c, (c, -1))]
+    index = PointIndex(points)
+    lastpt = (0, 0)
+    sorted_chains = []
+    while len(index):
+        dist2, (c, i), pt = index.nearest(lastpt[0], lastpt[1])
+        index.remove_group(c)
+        pts, closed = chains[c]
+        if closed:
+            pts = pts[i:-1] + pts[:i + 1]
+        elif i == -1:
+            pts = pts[::-1]
+        sorted_chains.append(pts)
+        lastpt = pts[-1]
+    order = improve_order([p[0] for p in sorted_chains], [p[-1] for p in sorted_chains], milling_params, reversible = True, rapids = rapids)
+    return [sorted_chains[i][::-1] if rev else sorted_chains[i] for i, rev in order]
+
+def cut_edges(gc, board, layer, milling_params, cache = None):
+    operation = gc.operation
+    chains = cached_toolpaths(gc, cache, toolpath_key('edges', board, layer, milling_params), lambda rapids: edge_toolpaths(board, layer, milling_params, rapids))
+    toolpath = polylines_toolpath(gc.grid, chains)
     depth = operation.zsurface
     while depth > operation.zdepth:
         depth = max(operation.zdepth, depth - abs(operation.zstep))
         gc.set_depth(depth)
-        last = None
-        for start, end in sorted_lines:
-            if last is None or (((start[0] - last[0])**2 + (start[1] - last[1])**2)**0.5) > 0.01:
-                gc.move_to(*start)
-            gc.line_to(*end)
-            last = end
+        gc.emit_toolpath(toolpath)
         
     gc.get_safe()
+
+# Area to rough out, as a shapely geometry in machine coordinates: the board
+# outside of the outermost isolation pass (the cleanup region), or outside
+# of the isolation paths widened by half a tool width with a single pass.
+# Always computed with shapely, as the pocketing works with it.
+def clearing_region(board, layer, milling_params):
+    view = isolation_view(board, layer)
+    pp = ShapelyPathGenerator(view, milling_params)
+    paths, drills = pp.generatePathsForLayer(layer, addCleanup = True)
+    region = paths.pop('cleanup', None)
+    if region is None:
+        region = pp.generateCleanup(paths)
+    return shapely.affinity.scale(region, 1.0 / view.scale, 1.0 / view.scale, origin = (0, 0))
+
+# Pocketing rings of the clearing region for an endmill of diameter tool,
+# joined with link_rings where the tool can stay down, as polylines in
+# cutting order. The rings are simplified to within clearing_tolerance, the
+# offsets are much finer than needed for roughing.
+clearing_tolerance = 0.01
+
+def clearing_toolpaths(board, layer, milling_params, tool, rapids = None):
+    area = pocket_area(clearing_region(board, layer, milling_params), tool)
+    rings = [list(r.simplify(clearing_tolerance).coords) for r in pocket_rings(area, tool)]
+    polylines = link_rings([ring for ring in rings if len(ring) > 1], area, tool, clearing_tolerance, start = (0, 0))
+    order = improve_order([p[0] for p in polylines], [p[-1] for p in polylines], milling_params, rapids = rapids)
+    return [polylines[i] for i, rev in order]
+
+def clear_copper(gc, board, layer, milling_params, cache = None):
+    operation = gc.operation
+    rings = cached_toolpaths(gc, cache, toolpath_key('clearing', board, layer, milling_params, operation.endmill_dia), lambda rapids: clearing_toolpaths(board, layer, milling_params, operation.endmill_dia, rapids))
+    toolpath = polylines_toolpath(gc.grid, rings)
+    depth = operation.zsurface
+    while depth > operation.zdepth:
+        depth = max(operation.zdepth, depth - abs(operation.zstep))
+        gc.set_depth(depth)
+        gc.emit_toolpath(toolpath)
+    gc.get_safe()
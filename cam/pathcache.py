@@ -0,0 +1,77 @@
+import hashlib
+import os
+import pickle
+
+# Bump when the toolpath generation changes in a way that makes old
+# cache entries invalid
+CACHE_VERSION = 4
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "wharrgrbl", "toolpaths")
+
+# Content-addressed on-disk cache of computed toolpaths (plain Python data,
+# pickled). The keys are tuples that are hashed into file names; the access
+# time is tracked with the file modification time, and the least recently
+# used entries are removed when the total size exceeds max_size bytes.
+class ToolpathCache(object):
+    def __init__(self, directory = None, max_size = 512 * 1048576):
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_size = max_size
+    def filename(self, key):
+        digest = hashlib.sha1(repr((CACHE_VERSION, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + ".pickle")
+    def get(self, key):
+        fname = self.filename(key)
+        try:
+            with open(fname, "rb") as f:
+                value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return value
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok = True)
+        fname = self.filename(key)
+        tmpname = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmpname, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, fname)
+        self.evict()
+    def entries(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pickle"):
+                fname = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                result.append((st.st_mtime, st.st_size, fname))
+        return result
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, fname in entries)
+        while entries and total > self.max_size:
+            mtime, size, fname = entries.pop(0)
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+            total -= size
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for mtime, size, fname in self.entries():
+                os.unlink(fname)
+
+# Returns compute(), going through the cache if there is one
+def cached_value(cache, key, compute):
+    if cache is None:
+        return compute()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.put(key, value)
+    return value
@@ -2,6 +2,10 @@ import sexpdata
 from PyQt5 import QtCore, QtGui, QtWidgets
 import sys
 import math
+import re
+import hashlib
+from array import array
+import numpy
 
 def sym2str(e):
     if type(e) is str:
@@ -12,6 +16,79 @@ def rotdeg(xy, angle):
     angle = math.pi * angle / 180
     return (x * math.cos(angle) + y * math.sin(angle), -x * math.sin(angle) + y * math.cos(angle))
 
+_sexpr_token_re = re.compile(r'[\s]*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.S)
+_sexpr_escape_re = re.compile(r'\\(.)', re.S)
+_sexpr_atom_parser = sexpdata.Parser('')
+
+# File wrapper computing a digest of everything read through it
+class HashingReader(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+    def read(self, size = -1):
+        data = self.fileobj.read(size)
+        self.hash.update(data.encode('utf-8') if isinstance(data, str) else data)
+        return data
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+def iter_sexpr_tokens(fileobj, chunk_size = 65536):
+    # Yields ('(', None), (')', None), ('str', value) or ('atom', value),
+    # reading the file in chunks instead of all at once
+    buf = ''
+    eof = False
+    while True:
+        if not eof:
+            chunk = fileobj.read(chunk_size)
+            if chunk:
+                buf += chunk
+            else:
+                eof = True
+        pos = 0
+        while True:
+            m = _sexpr_token_re.match(buf, pos)
+            # A token touching the end of the buffer may continue in the next chunk
+            if m is None or (m.end() == len(buf) and not eof):
+                break
+            pos = m.end()
+            if m.group(1):
+                yield ('(', None)
+            elif m.group(2):
+                yield (')', None)
+            elif m.group(3) is not None:
+                yield ('str', _sexpr_escape_re.sub(lambda e: sexpdata.String.unquote(e.group(0)), m.group(3)))
+            else:
+                yield ('atom', _sexpr_atom_parser.atom(m.group(4)))
+        buf = buf[pos:]
+        if eof:
+            if buf.strip() != '':
+                raise ValueError("Unexpected data at the end of the file: %s" % buf[:20])
+            return
+
+def iter_sexpr_items(fileobj, chunk_size = 65536):
+    # Yields the children of the top level list one by one, so only the item
+    # being currently parsed needs to be held in memory
+    stack = []
+    for kind, value in iter_sexpr_tokens(fileobj, chunk_size):
+        if kind == '(':
+            stack.append([])
+        elif kind == ')':
+            if not stack:
+                raise ValueError("Unbalanced parentheses")
+            item = stack.pop()
+            if len(stack) == 1:
+                yield item
+            elif len(stack) > 1:
+                stack[-1].append(item)
+        elif len(stack) == 1:
+            yield value
+        elif stack:
+            stack[-1].append(value)
+        else:
+            raise ValueError("Unexpected atom outside of a list")
+    if stack:
+        raise ValueError("Unbalanced parentheses")
+
 class Segment(object):
     def __init__(self, start, end, width, layer, net):
         self.start = (float(start[0]), float(start[1]))
@@ -31,6 +108,45 @@ class GraphicLine(object):
     def __str__(self):
         return "%s: gr-line (%f, %f) - (%f, %f) width: %f" % (self.layer, self.start[0], self.start[1], self.end[0], self.end[1], self.width)
 
+# Max distance between an arc and the lines approximating it
+ARC_TOLERANCE = 0.005
+
+# Lines approximating the arc around center from start, turning by angle
+# degrees (clockwise on the board, as in KiCad); end replaces the computed
+# end point if given
+def arc_to_lines(center, start, angle, width, layer, end = None, tolerance = ARC_TOLERANCE):
+    cx, cy = float(center[0]), float(center[1])
+    dx, dy = float(start[0]) - cx, float(start[1]) - cy
+    r = math.hypot(dx, dy)
+    if r <= tolerance:
+        return []
+    a0 = math.atan2(dy, dx)
+    sweep = math.pi * float(angle) / 180
+    step = 2 * math.acos(max(1 - tolerance / r, -1))
+    n = max(int(math.ceil(abs(sweep) / step)), 1)
+    pts = [(float(start[0]), float(start[1]))]
+    for i in range(1, n + 1):
+        a = a0 + sweep * i / n
+        pts.append((cx + r * math.cos(a), cy + r * math.sin(a)))
+    if end is not None:
+        pts[-1] = (float(end[0]), float(end[1]))
+    return [GraphicLine(start = pts[i], end = pts[i + 1], width = width, layer = layer) for i in range(n)]
+
+# Center and angle of the arc from start through mid to end (KiCad 6 format)
+def arc_from_points(start, mid, end):
+    (x1, y1), (x2, y2), (x3, y3) = [(float(p[0]), float(p[1])) for p in (start, mid, end)]
+    d = 2 * (x1 * (y2 - y3) + x2 * (y3 - y1) + x3 * (y1 - y2))
+    if abs(d) < 1e-12:
+        return None, None
+    s1, s2, s3 = x1 * x1 + y1 * y1, x2 * x2 + y2 * y2, x3 * x3 + y3 * y3
+    cx = (s1 * (y2 - y3) + s2 * (y3 - y1) + s3 * (y1 - y2)) / d
+    cy = (s1 * (x3 - x2) + s2 * (x1 - x3) + s3 * (x2 - x1)) / d
+    a1, a2, a3 = [math.atan2(y - cy, x - cx) for x, y in ((x1, y1), (x2, y2), (x3, y3))]
+    sweep = (a3 - a1) % (2 * math.pi)
+    if (a2 - a1) % (2 * math.pi) > sweep:
+        sweep -= 2 * math.pi
+    return (cx, cy), sweep * 180 / math.pi
+
 class PCBPad(object):
     def __init__(self, x, y, w, h, shape, pad_type, layers, net, drillx, drilly):
         self.x = x
@@ -44,17 +160,264 @@ class PCBPad(object):
         self.drillx = drillx
         self.drilly = drilly
 
+# Columnar storage for board primitives. Every numeric field is kept in its
+# own array, so that bulk operations can work on whole columns at once,
+# while iterating or indexing still returns objects with the same attributes
+# as Segment, GraphicLine and PCBPad (lightweight views into the columns).
+class ColumnArray(object):
+    # (name, array typecode or None for a plain list)
+    columns = ()
+    view = None
+    def __init__(self):
+        for name, typecode in self.columns:
+            setattr(self, name, array(typecode) if typecode is not None else [])
+    def append_values(self, *values):
+        for (name, typecode), value in zip(self.columns, values):
+            getattr(self, name).append(value)
+    def __len__(self):
+        return len(getattr(self, self.columns[0][0]))
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.view(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("%s index out of range" % type(self).__name__)
+        return self.view(self, index)
+    def __iter__(self):
+        view = self.view
+        for i in range(len(self)):
+            yield view(self, i)
+
+class ColumnView(object):
+    __slots__ = ('owner', 'index')
+    def __init__(self, owner, index):
+        self.owner = owner
+        self.index = index
+    def __eq__(self, other):
+        return type(self) is type(other) and self.owner is other.owner and self.index == other.index
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash((id(self.owner), self.index))
+
+class SegmentView(ColumnView):
+    __slots__ = ()
+    start = property(lambda self: (self.owner.x1[self.index], self.owner.y1[self.index]))
+    end = property(lambda self: (self.owner.x2[self.index], self.owner.y2[self.index]))
+    width = property(lambda self: self.owner.width[self.index])
+    layer = property(lambda self: self.owner.layer)
+    net = property(lambda self: self.owner.net[self.index])
+    __str__ = Segment.__str__
+
+class SegmentArray(ColumnArray):
+    columns = (('x1', 'd'), ('y1', 'd'), ('x2', 'd'), ('y2', 'd'), ('width', 'd'), ('net', 'l'))
+    view = SegmentView
+    def __init__(self, layer):
+        ColumnArray.__init__(self)
+        self.layer = layer
+    def append(self, seg):
+        self.append_values(seg.start[0], seg.start[1], seg.end[0], seg.end[1], seg.width, seg.net)
+
+class GraphicLineView(ColumnView):
+    __slots__ = ()
+    start = property(lambda self: (self.owner.x1[self.index], self.owner.y1[self.index]))
+    end = property(lambda self: (self.owner.x2[self.index], self.owner.y2[self.index]))
+    width = property(lambda self: self.owner.width[self.index])
+    layer = property(lambda self: self.owner.layer)
+    __str__ = GraphicLine.__str__
+
+class GraphicLineArray(ColumnArray):
+    columns = (('x1', 'd'), ('y1', 'd'), ('x2', 'd'), ('y2', 'd'), ('width', 'd'))
+    view = GraphicLineView
+    def __init__(self, layer):
+        ColumnArray.__init__(self)
+        self.layer = layer
+    def append(self, line):
+        self.append_values(line.start[0], line.start[1], line.end[0], line.end[1], line.width)
+
+class PadView(ColumnView):
+    __slots__ = ()
+    x = property(lambda self: self.owner.x[self.index])
+    y = property(lambda self: self.owner.y[self.index])
+    w = property(lambda self: self.owner.w[self.index])
+    h = property(lambda self: self.owner.h[self.index])
+    shape = property(lambda self: self.owner.shape[self.index])
+    pad_type = property(lambda self: self.owner.pad_type[self.index])
+    layers = property(lambda self: self.owner.layers[self.index])
+    net = property(lambda self: self.owner.net[self.index])
+    drillx = property(lambda self: self.owner.drillx[self.index])
+    drilly = property(lambda self: self.owner.drilly[self.index])
+
+class PadArray(ColumnArray):
+    columns = (('x', 'd'), ('y', 'd'), ('w', 'd'), ('h', 'd'), ('drillx', 'd'), ('drilly', 'd'), ('net', 'l'), ('shape', None), ('pad_type', None), ('layers', None))
+    view = PadView
+    def append(self, pad):
+        self.append_values(pad.x, pad.y, pad.w, pad.h, pad.drillx, pad.drilly, pad.net, pad.shape, pad.pad_type, pad.layers)
+
+# Polygon outline stored as a flat x, y, x, y... array of doubles
+class PointArray(object):
+    def __init__(self, pts = ()):
+        self.coords = array('d')
+        for pt in pts:
+            self.append(pt)
+    def append(self, pt):
+        self.coords.append(pt[0])
+        self.coords.append(pt[1])
+    def __len__(self):
+        return len(self.coords) >> 1
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("PointArray index out of range")
+        return (self.coords[2 * index], self.coords[2 * index + 1])
+    def __iter__(self):
+        it = iter(self.coords)
+        return zip(it, it)
+    def __eq__(self, other):
+        if isinstance(other, PointArray):
+            return self.coords == other.coords
+        return list(self) == list(other)
+    def __ne__(self, other):
+        return not self == other
+
 class PCBLayer(object):
     def __init__(self, name):
         self.name = name
-        self.segments = []
+        self.segments = SegmentArray(name)
         self.polygons = {}
+        self.pads = PadArray()
+        self.gr_lines = GraphicLineArray(name)
+        self.extents_cache = None
+        self.index_cache = None
+    # Storage is append-only, so the item counts identify the layer contents
+    def change_key(self):
+        return (len(self.segments), len(self.pads), len(self.gr_lines), tuple((net, sum(len(p) for p in polys)) for net, polys in self.polygons.items()))
+    # Spatial index of the layer, rebuilt only when primitives are added
+    def get_index(self):
+        key = self.change_key()
+        if self.index_cache is None or self.index_cache[0] != key:
+            self.index_cache = (key, LayerIndex(self))
+        return self.index_cache[1]
+    # (minx, miny, maxx, maxy) of segments, graphic lines and zone outlines, None if empty
+    def get_extents(self):
+        key = self.change_key()
+        if self.extents_cache is None or self.extents_cache[0] != key:
+            self.extents_cache = (key, self.calc_extents())
+        return self.extents_cache[1]
+    def calc_extents(self):
+        bounds = []
+        for lines in (self.segments, self.gr_lines):
+            if len(lines):
+                xs = [numpy.frombuffer(lines.x1), numpy.frombuffer(lines.x2)]
+                ys = [numpy.frombuffer(lines.y1), numpy.frombuffer(lines.y2)]
+                bounds.append((min(c.min() for c in xs), min(c.min() for c in ys), max(c.max() for c in xs), max(c.max() for c in ys)))
+        for polys in self.polygons.values():
+            for p in polys:
+                if len(p):
+                    xy = numpy.frombuffer(p.coords).reshape(-1, 2)
+                    mins = xy.min(axis = 0)
+                    maxs = xy.max(axis = 0)
+                    bounds.append((mins[0], mins[1], maxs[0], maxs[1]))
+        return merge_extents(bounds)
+
+class LayerQuery(object):
+    def __init__(self):
+        self.segments = []
         self.pads = []
         self.gr_lines = []
+        self.polygons = []
+
+# Uniform grid over the primitives of a layer. Every cell lists the indices
+# of the primitives whose bounding box overlaps it, so rectangular regions
+# can be queried without visiting the whole layer.
+class LayerIndex(object):
+    kinds = ('segments', 'pads', 'gr_lines', 'polygons')
+    def __init__(self, layer, cell_size = None):
+        self.polygons = []
+        boxes = {}
+        segs = layer.segments
+        if len(segs):
+            x1, y1, x2, y2, w = [numpy.frombuffer(c) for c in (segs.x1, segs.y1, segs.x2, segs.y2, segs.width)]
+            boxes['segments'] = numpy.column_stack([numpy.minimum(x1, x2) - w / 2, numpy.minimum(y1, y2) - w / 2, numpy.maximum(x1, x2) + w / 2, numpy.maximum(y1, y2) + w / 2])
+        lines = layer.gr_lines
+        if len(lines):
+            x1, y1, x2, y2, w = [numpy.frombuffer(c) for c in (lines.x1, lines.y1, lines.x2, lines.y2, lines.width)]
+            boxes['gr_lines'] = numpy.column_stack([numpy.minimum(x1, x2) - w / 2, numpy.minimum(y1, y2) - w / 2, numpy.maximum(x1, x2) + w / 2, numpy.maximum(y1, y2) + w / 2])
+        pads = layer.pads
+        if len(pads):
+            x, y, w, h = [numpy.frombuffer(c) for c in (pads.x, pads.y, pads.w, pads.h)]
+            boxes['pads'] = numpy.column_stack([x - w / 2, y - h / 2, x + w / 2, y + h / 2])
+        pboxes = []
+        for net, polys in layer.polygons.items():
+            for i, p in enumerate(polys):
+                if len(p):
+                    xy = numpy.frombuffer(p.coords).reshape(-1, 2)
+                    self.polygons.append((net, i))
+                    pboxes.append(numpy.concatenate([xy.min(axis = 0), xy.max(axis = 0)]))
+        if pboxes:
+            boxes['polygons'] = numpy.array(pboxes)
+        self.boxes = boxes
+        self.cells = {}
+        if not boxes:
+            self.origin = (0.0, 0.0)
+            self.cell_size = 1.0
+            self.limits = (0, 0)
+            return
+        allboxes = numpy.concatenate(list(boxes.values()))
+        minx, miny = allboxes[:, 0].min(), allboxes[:, 1].min()
+        maxx, maxy = allboxes[:, 2].max(), allboxes[:, 3].max()
+        if cell_size is None:
+            # Aim for a handful of primitives per cell
+            cell_size = max(((maxx - minx) * (maxy - miny) * 4.0 / len(allboxes)) ** 0.5, 0.5)
+        self.origin = (float(minx), float(miny))
+        self.cell_size = float(cell_size)
+        self.limits = (int((maxx - minx) // cell_size), int((maxy - miny) // cell_size))
+        for kind, b in boxes.items():
+            cells = self.cells[kind] = {}
+            ix0, iy0, ix1, iy1 = [c.tolist() for c in self.cellRange(b)]
+            for i in range(len(b)):
+                for cx in range(ix0[i], ix1[i] + 1):
+                    for cy in range(iy0[i], iy1[i] + 1):
+                        cells.setdefault((cx, cy), []).append(i)
+    def cellRange(self, boxes):
+        ox, oy = self.origin
+        return (numpy.floor((boxes[:, 0] - ox) / self.cell_size).astype(int),
+            numpy.floor((boxes[:, 1] - oy) / self.cell_size).astype(int),
+            numpy.floor((boxes[:, 2] - ox) / self.cell_size).astype(int),
+            numpy.floor((boxes[:, 3] - oy) / self.cell_size).astype(int))
+    # Primitives whose bounding box, grown by margin, intersects the
+    # (minx, miny, maxx, maxy) rectangle; indices are returned in file order,
+    # polygons as (net, index) pairs
+    def query(self, rect, margin = 0):
+        minx, miny, maxx, maxy = rect[0] - margin, rect[1] - margin, rect[2] + margin, rect[3] + margin
+        ix0, iy0, ix1, iy1 = [int(c[0]) for c in self.cellRange(numpy.array([[minx, miny, maxx, maxy]]))]
+        ix0, iy0 = max(ix0, 0), max(iy0, 0)
+        ix1, iy1 = min(ix1, self.limits[0]), min(iy1, self.limits[1])
+        result = LayerQuery()
+        for kind, cells in self.cells.items():
+            b = self.boxes[kind]
+            found = set()
+            for cx in range(ix0, ix1 + 1):
+                for cy in range(iy0, iy1 + 1):
+                    found.update(cells.get((cx, cy), ()))
+            found = [i for i in sorted(found) if b[i, 0] <= maxx and b[i, 2] >= minx and b[i, 1] <= maxy and b[i, 3] >= miny]
+            if kind == 'polygons':
+                found = [self.polygons[i] for i in found]
+            setattr(result, kind, found)
+        return result
+
+def merge_extents(bounds):
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+        return None
+    return (float(min(b[0] for b in bounds)), float(min(b[1] for b in bounds)), float(max(b[2] for b in bounds)), float(max(b[3] for b in bounds)))
 
 class KicadBoard(object):
-    def __init__(self, fileobj):
-        self.sexpr = sexpdata.load(fileobj)
+    def __init__(self, fileobj, streaming = False):
         self.version = None
         self.host = None
         self.host_version = None
@@ -64,9 +427,29 @@ class KicadBoard(object):
         self.nets = {}
         self.layers = {}
         self.pcbplotparams = {}
-        if self.sexpr[0].value() != 'kicad_pcb':
+        # Content hash of the source file, used as a key for cached toolpaths
+        self.digest = None
+        fileobj = HashingReader(fileobj)
+        if streaming:
+            # Do not keep the whole tree around, only one top level item at a time
+            self.sexpr = None
+            items = iter_sexpr_items(fileobj)
+            head = next(items, None)
+        else:
+            self.sexpr = sexpdata.load(fileobj)
+            items = self.sexpr[1:]
+            head = self.sexpr[0]
+        if type(head) is not sexpdata.Symbol or head.value() != 'kicad_pcb':
             raise ValueError("Not a kicad pcb file")
-            
+        for e in items:
+            self.parse_item(e)
+        self.digest = fileobj.hexdigest()
+        #print self.version, self.host, self.host_version, self.page
+        #print self.general
+        #print self.setup
+        #print self.pcbplotparams
+        #print self.nets
+    def parse_item(self, e):
         def parsedict(dictout, node, subtrees = {}):
             for g in node[1:]:
                 name = g[0].value()
@@ -77,136 +460,168 @@ class KicadBoard(object):
                 else:
                     dictout[g[0].value()] = g[1:]
             
-        for e in self.sexpr[1:]:
-            sym = e[0].value()
-            if sym == 'version':
-                self.version = e[1]
-            elif sym == 'host':
-                self.host = e[1].value()
-                self.host_version = e[2]
-            elif sym == 'page':
-                self.page = e[1].value()
-            elif sym == 'general':
-                parsedict(self.general, e)
-            elif sym == 'setup':
-                parsedict(self.setup, e, {'pcbplotparams' : self.pcbplotparams})
-            elif sym == 'net':
-                self.nets[int(e[1])] = sym2str(e[2])
-            elif sym == 'module' or sym == 'footprint':
-                x, y, angle = None, None, 0
-                for si in e[2:]:
-                    if type(si) is sexpdata.Symbol:
-                        continue
-                    sym = si[0].value()
-                    if sym == 'at':
-                        x, y = float(si[1]), float(si[2])
-                        if len(si) > 3:
-                            angle = si[3]
-                    elif sym == 'pad':
-                        pad_type = sym2str(si[2])
-                        pad_shape = sym2str(si[3])
-                        padx, pady = None, None
-                        padw, padh = None, None
-                        padangle = angle
-                        layers = None
-                        net = 0
-                        drillx = 0
-                        drilly = 0
-                        for pat in si[4:]:
-                            sym = pat[0].value()
-                            if sym == 'at':
-                                paddx, paddy = rotdeg((float(pat[1]), float(pat[2])), angle)
-                                padx, pady = float(x + paddx), float(y + paddy)
-                                if len(pat) > 3:
-                                    padangle = pat[3]
-                            elif sym == 'size':
-                                padw, padh = float(pat[1]), float(pat[2])
-                            elif sym == 'drill' and len(pat) > 1:
-                                if type(pat[1]) in [float, int]:
-                                    drillx, drilly = float(pat[1]), float(pat[1])
-                                elif sym2str(pat[1]) == 'oval':
-                                    drillx = float(pat[2])
-                                    if len(pat) == 3:
-                                        drilly = drillx
-                                    else:
-                                        drilly = float(pat[3])
-                            elif sym == 'layers':
-                                layers = list(map(sym2str, pat[1:]))
-                            elif sym == 'net':
-                                net = pat[1]
-                        if padangle in [90, 270]:
-                            padw, padh = padh, padw
-                            drillx, drilly = drilly, drillx
-                        self.add_pad(PCBPad(padx, pady, padw, padh, pad_shape, pad_type, layers, net, drillx, drilly))
-            elif sym == 'zone':
-                net = None
-                layer = None
-                for si in e[1:]:
-                    sym = si[0].value()
-                    if sym == 'net':
-                        net = si[1]
-                    elif sym == 'layer':
-                        layer = sym2str(si[1])
-                    elif sym == 'filled_polygon':
-                        fpLayer = layer
-                        ptsIn = None
-                        pts = []
-                        for fpItem in si[1:]:
-                            fpSym = sym2str(fpItem[0])
-                            if fpSym == 'pts':
-                                ptsIn = fpItem[1:]
-                            elif fpSym == 'layer':
-                                fpLayer = fpItem[1]
-                        if ptsIn is None:
-                            raise ValueError("No pts item inside filled_polygon")
-                        for xy in ptsIn:
-                            if sym2str(xy[0]) != 'xy':
-                                raise ValueError("Invalid item inside filled_polygon pts")
-                            pts.append((float(xy[1]), float(xy[2])))
-                        lp = self.get_layer(fpLayer).polygons
-                        if net not in lp:
-                            lp[net] = [pts]
-                        else:
-                            lp[net].append(pts)
-            elif sym == 'segment':
-                start = None
-                end = None
-                width = None
-                net = None
-                for si in e[1:]:
-                    sym = si[0].value()
-                    if sym == 'start':
-                        start = (si[1], si[2])
-                    if sym == 'end':
-                        end = (si[1], si[2])
-                    if sym == 'width':
-                        width = si[1]
-                    if sym == 'layer':
-                        layer = sym2str(si[1])
-                    if sym == 'net':
-                        net = si[1]
-                self.get_layer(layer).segments.append(Segment(start = start, end = end, width = width, layer = layer, net = net))
-            elif sym == 'gr_line':
-                start = None
-                end = None
-                width = None
-                for si in e[1:]:
-                    sym = si[0].value()
-                    if sym == 'start':
-                        start = (si[1], si[2])
-                    if sym == 'end':
-                        end = (si[1], si[2])
-                    if sym == 'width':
-                        width = si[1]
-                    if sym == 'layer':
-                        layer = sym2str(si[1])
-                self.get_layer(layer).gr_lines.append(GraphicLine(start = start, end = end, width = width, layer = layer))
-                
-        #print self.version, self.host, self.host_version, self.page
-        #print self.general
-        #print self.setup
-        #print self.pcbplotparams
-        #print self.nets
+        sym = e[0].value()
+        if sym == 'version':
+            self.version = e[1]
+        elif sym == 'host':
+            self.host = e[1].value()
+            self.host_version = e[2]
+        elif sym == 'page':
+            self.page = e[1].value()
+        elif sym == 'general':
+            parsedict(self.general, e)
+        elif sym == 'setup':
+            parsedict(self.setup, e, {'pcbplotparams' : self.pcbplotparams})
+        elif sym == 'net':
+            self.nets[int(e[1])] = sym2str(e[2])
+        elif sym == 'module' or sym == 'footprint':
+            x, y, angle = None, None, 0
+            for si in e[2:]:
+                if type(si) is sexpdata.Symbol:
+                    continue
+                sym = si[0].value()
+                if sym == 'at':
+                    x, y = float(si[1]), float(si[2])
+                    if len(si) > 3:
+                        angle = si[3]
+                elif sym == 'pad':
+                    pad_type = sym2str(si[2])
+                    pad_shape = sym2str(si[3])
+                    padx, pady = None, None
+                    padw, padh = None, None
+                    padangle = angle
+                    layers = None
+                    net = 0
+                    drillx = 0
+                    drilly = 0
+                    for pat in si[4:]:
+                        sym = pat[0].value()
+                        if sym == 'at':
+                            paddx, paddy = rotdeg((float(pat[1]), float(pat[2])), angle)
+                            padx, pady = float(x + paddx), float(y + paddy)
+                            if len(pat) > 3:
+                                padangle = pat[3]
+                        elif sym == 'size':
+                            padw, padh = float(pat[1]), float(pat[2])
+                        elif sym == 'drill' and len(pat) > 1:
+                            if type(pat[1]) in [float, int]:
+                                drillx, drilly = float(pat[1]), float(pat[1])
+                            elif sym2str(pat[1]) == 'oval':
+                                drillx = float(pat[2])
+                                if len(pat) == 3:
+                                    drilly = drillx
+                                else:
+                                    drilly = float(pat[3])
+                        elif sym == 'layers':
+                            layers = list(map(sym2str, pat[1:]))
+                        elif sym == 'net':
+                            net = pat[1]
+                    if padangle in [90, 270]:
+                        padw, padh = padh, padw
+                        drillx, drilly = drilly, drillx
+                    self.add_pad(PCBPad(padx, pady, padw, padh, pad_shape, pad_type, layers, net, drillx, drilly))
+        elif sym == 'zone':
+            net = None
+            layer = None
+            for si in e[1:]:
+                sym = si[0].value()
+                if sym == 'net':
+                    net = si[1]
+                elif sym == 'layer':
+                    layer = sym2str(si[1])
+                elif sym == 'filled_polygon':
+                    fpLayer = layer
+                    ptsIn = None
+                    pts = PointArray()
+                    for fpItem in si[1:]:
+                        fpSym = sym2str(fpItem[0])
+                        if fpSym == 'pts':
+                            ptsIn = fpItem[1:]
+                        elif fpSym == 'layer':
+                            fpLayer = fpItem[1]
+                    if ptsIn is None:
+                        raise ValueError("No pts item inside filled_polygon")
+                    for xy in ptsIn:
+                        if sym2str(xy[0]) != 'xy':
+                            raise ValueError("Invalid item inside filled_polygon pts")
+                        pts.append((float(xy[1]), float(xy[2])))
+                    lp = self.get_layer(fpLayer).polygons
+                    if net not in lp:
+                        lp[net] = [pts]
+                    else:
+                        lp[net].append(pts)
+        elif sym == 'segment':
+            start = None
+            end = None
+            width = None
+            net = None
+            for si in e[1:]:
+                sym = si[0].value()
+                if sym == 'start':
+                    start = (si[1], si[2])
+                if sym == 'end':
+                    end = (si[1], si[2])
+                if sym == 'width':
+                    width = si[1]
+                if sym == 'layer':
+                    layer = sym2str(si[1])
+                if sym == 'net':
+                    net = si[1]
+            self.get_layer(layer).segments.append(Segment(start = start, end = end, width = width, layer = layer, net = net))
+        elif sym == 'gr_line':
+            start = None
+            end = None
+            width = None
+            for si in e[1:]:
+                sym = si[0].value()
+                if sym == 'start':
+                    start = (si[1], si[2])
+                if sym == 'end':
+                    end = (si[1], si[2])
+                if sym == 'width':
+                    width = si[1]
+                if sym == 'layer':
+                    layer = sym2str(si[1])
+            self.get_layer(layer).gr_lines.append(GraphicLine(start = start, end = end, width = width, layer = layer))
+        elif sym == 'gr_arc' or sym == 'gr_circle':
+            # Stored as the lines approximating them
+            start = None
+            mid = None
+            end = None
+            center = None
+            angle = None
+            width = 0
+            for si in e[1:]:
+                sym = si[0].value()
+                if sym == 'start':
+                    start = (si[1], si[2])
+                if sym == 'mid':
+                    mid = (si[1], si[2])
+                if sym == 'end':
+                    end = (si[1], si[2])
+                if sym == 'center':
+                    center = (si[1], si[2])
+                if sym == 'angle':
+                    angle = si[1]
+                if sym == 'width':
+                    width = si[1]
+                if sym == 'layer':
+                    layer = sym2str(si[1])
+            if center is not None:
+                # gr_circle, end is a point on the circle
+                start, angle, end = end, 360, end
+            elif mid is not None:
+                center, angle = arc_from_points(start, mid, end)
+            else:
+                # KiCad 5 gr_arc: start is the center, end the start of the arc
+                center, start, end = start, end, None
+            if center is not None and start is not None and angle is not None:
+                lines = self.get_layer(layer).gr_lines
+                for line in arc_to_lines(center, start, angle, width, layer, end):
+                    lines.append(line)
+    # Bounding box of all layers, pads excluded; cached per layer until it changes
+    def get_extents(self):
+        return merge_extents([l.get_extents() for l in self.layers.values()])
     def add_pad(self, pad):
         if len(pad.layers) == 0:
             # XXXKF not really correct, but there's no better alternative yet
@@ -0,0 +1,45 @@
+import numpy
+
+# Douglas-Peucker simplification of polylines: drops the points that are not
+# needed for the simplified line to stay within tolerance (the chord error)
+# of the original one. The first and last points are always kept, so closed
+# rings (first point repeated at the end) stay closed.
+
+# Distances of the points from the segment a-b
+def segment_distances(pts, a, b):
+    ab = b - a
+    l2 = float(ab.dot(ab))
+    if l2 == 0:
+        d = pts - a
+    else:
+        t = numpy.clip((pts - a).dot(ab) / l2, 0.0, 1.0)
+        d = pts - (a + t[:, None] * ab)
+    return numpy.sqrt((d * d).sum(axis = 1))
+
+# Boolean array of the points of xy (n x 2 array) kept by the simplification
+def simplify_mask(xy, tolerance):
+    n = len(xy)
+    keep = numpy.zeros(n, dtype = bool)
+    if n < 3 or tolerance <= 0:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        d = segment_distances(xy[a + 1:b], xy[a], xy[b])
+        k = int(d.argmax())
+        if d[k] > tolerance:
+            k += a + 1
+            keep[k] = True
+            stack.append((a, k))
+            stack.append((k, b))
+    return keep
+
+def simplify_polyline(points, tolerance):
+    if tolerance <= 0 or len(points) < 3:
+        return list(points)
+    keep = simplify_mask(numpy.asarray(points, dtype = float).reshape(-1, 2), tolerance)
+    return [points[i] for i in numpy.flatnonzero(keep)]
@@ -0,0 +1,136 @@
+import time
+import numpy
+
+# Tour improvement for the greedy orderings of contours, holes and edge cuts.
+#
+# A tour is a list of items, each with an entry and an exit point, starting
+# from a fixed point. The cost is the total length of the rapids, i.e. the
+# distances from each item's exit to the next item's entry. Items marked as
+# reversible may be traversed backwards (entry and exit swapped), e.g. edge
+# cut lines; holes and closed contours have entry == exit.
+
+def rapid_distance(start, entries, exits):
+    total = 0.0
+    last = start
+    for entry, exit in zip(entries, exits):
+        total += ((entry[0] - last[0])**2 + (entry[1] - last[1])**2) ** 0.5
+        last = exit
+    return total
+
+class TourImprover(object):
+    def __init__(self, start, entries, exits, reversible):
+        # Element 0 is the fixed starting point
+        self.entries = numpy.array([start] + list(entries), dtype = float).reshape(-1, 2)
+        self.exits = numpy.array([start] + list(exits), dtype = float).reshape(-1, 2)
+        self.reversible = reversible
+        self.order = list(range(-1, len(entries)))
+        self.flipped = [False] * len(self.order)
+
+    def cost(self):
+        d = self.entries[1:] - self.exits[:-1]
+        return float(numpy.sqrt((d * d).sum(axis = 1)).sum())
+
+    @staticmethod
+    def dist(a, b):
+        d = a - b
+        return numpy.sqrt((d * d).sum(axis = -1))
+
+    # Link lengths exit[k] -> entry[k + 1], with a zero-length link after the last item
+    def links(self):
+        return numpy.append(self.dist(self.exits[:-1], self.entries[1:]), 0.0)
+
+    # Best segment reversal starting at position i, as (gain, j)
+    def best_2opt(self, i, links):
+        n = len(self.entries)
+        E, X = self.entries, self.exits
+        js = numpy.arange(i, n)
+        nexts = numpy.minimum(js + 1, n - 1)
+        is_last = js == n - 1
+        old = links[i - 1] + links[js]
+        new = self.dist(X[i - 1], X[js]) + numpy.where(is_last, 0.0, self.dist(E[i], E[nexts]))
+        gains = old - new
+        k = int(gains.argmax())
+        return gains[k], i + k
+
+    def apply_2opt(self, i, j):
+        self.entries[i:j + 1], self.exits[i:j + 1] = self.exits[i:j + 1][::-1].copy(), self.entries[i:j + 1][::-1].copy()
+        self.order[i:j + 1] = self.order[i:j + 1][::-1]
+        self.flipped[i:j + 1] = [not f for f in self.flipped[i:j + 1][::-1]]
+
+    # Best move of the chain i..i+length-1 to another place, as (gain, k):
+    # the chain is reinserted after the element now at position k
+    def best_oropt(self, i, length, links):
+        n = len(self.entries)
+        E, X = self.entries, self.exits
+        last = i + length - 1
+        if last >= n:
+            return 0.0, None
+        if last == n - 1:
+            removal = links[i - 1]
+        else:
+            removal = links[i - 1] + links[last] - self.dist(X[i - 1], E[last + 1])
+        ks = numpy.arange(0, n)
+        ks = ks[(ks < i - 1) | (ks > last)]
+        if not len(ks):
+            return 0.0, None
+        nexts = numpy.minimum(ks + 1, n - 1)
+        is_last = ks == n - 1
+        insertion = self.dist(X[ks], E[i]) + numpy.where(is_last, 0.0, self.dist(X[last], E[nexts]) - links[ks])
+        gains = removal - insertion
+        best = int(gains.argmax())
+        return gains[best], int(ks[best])
+
+    def apply_oropt(self, i, length, k):
+        chain = slice(i, i + length)
+        items = [numpy.delete(a, numpy.s_[chain], axis = 0) for a in (self.entries, self.exits)]
+        moved = [a[chain].copy() for a in (self.entries, self.exits)]
+        order = self.order[chain]
+        flipped = self.flipped[chain]
+        del self.order[chain]
+        del self.flipped[chain]
+        pos = k + 1 if k < i else k + 1 - length
+        self.entries = numpy.concatenate([items[0][:pos], moved[0], items[0][pos:]])
+        self.exits = numpy.concatenate([items[1][:pos], moved[1], items[1][pos:]])
+        self.order[pos:pos] = order
+        self.flipped[pos:pos] = flipped
+
+    def improve(self, time_budget, eps = 1e-6):
+        deadline = time.time() + time_budget
+        n = len(self.entries)
+        # Reversing a segment of items that cannot be reversed themselves is
+        # only possible if they start and end at the same point
+        use_2opt = self.reversible or numpy.array_equal(self.entries, self.exits)
+        improved = True
+        while improved and time.time() < deadline:
+            improved = False
+            links = self.links()
+            for i in range(1, n):
+                if time.time() >= deadline:
+                    break
+                if use_2opt:
+                    gain, j = self.best_2opt(i, links)
+                    if gain > eps:
+                        self.apply_2opt(i, j)
+                        links = self.links()
+                        improved = True
+                for length in (1, 2, 3):
+                    if i + length > n:
+                        break
+                    gain, k = self.best_oropt(i, length, links)
+                    if k is not None and gain > eps:
+                        self.apply_oropt(i, length, k)
+                        links = self.links()
+                        improved = True
+                        break
+
+# Improves the order of the items within time_budget seconds, using 2-opt
+# segment reversals and Or-opt moves of chains of 1-3 items. Returns the new
+# order as a list of (original index, flipped) and the rapid distance before
+# and after.
+def improve_tour(start, entries, exits, time_budget, reversible = False):
+    improver = TourImprover(start, entries, exits, reversible)
+    before = improver.cost()
+    if len(entries) > 2 and time_budget > 0:
+        improver.improve(time_budget)
+    after = improver.cost()
+    return list(zip(improver.order[1:], improver.flipped[1:])), before, after
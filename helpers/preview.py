@@ -1,13 +1,14 @@
 import math
 import sys
 from PyQt5 import QtCore, QtGui, QtWidgets
-from cam.mill import BoardSizer, PathGenerator
+from cam.mill import BoardSizer, PathGenerator, GeometryCache
 
 class PathPreview(QtWidgets.QWidget):
     
     def __init__(self, view, milling_params):
         super(PathPreview, self).__init__()
         self.pathgen = PathGenerator(view, milling_params)
+        self.geometry_cache = GeometryCache()
         self.view = view
 
         self.initUI()
@@ -32,8 +33,12 @@ class PathPreview(QtWidgets.QWidget):
         pt = e.localPos()
         if not self.dragging:
             self.highlight_net = None
+            nets = self.pathgen.netsNearPoint(self.view.cur_layer, pt.x(), pt.y()) if self.view.board is not None else set()
+            nets.add('cleanup')
+            # The paths are kept in reference coordinates, see recalcAndRepaint
+            refpt = self.pathgen.referenceTransform().inverted()[0].map(pt)
             for net, path in list(self.paths.items()):
-                if path.contains(pt):
+                if net in nets and path.contains(refpt):
                     self.highlight_net = net
                     print("Highlight %s" % net)
             self.repaint()
@@ -58,7 +63,9 @@ class PathPreview(QtWidgets.QWidget):
 
     def recalcAndRepaint(self):
         if self.view.board is not None:
-            self.paths, self.drills = self.pathgen.generatePathsForLayer(self.view.cur_layer, addCleanup = True)
+            # Zoom and mirroring only change the transform set in paintEvent,
+            # not the geometry
+            self.paths, self.drills = self.geometry_cache.get(self.pathgen, self.view.cur_layer)
         else:
             self.paths, self.drills = {}, []
         self.repaint()
@@ -91,6 +98,10 @@ class PathPreview(QtWidgets.QWidget):
             qp.setBrush(QtGui.QBrush(QtGui.QColor(240, 0, 120), 4))
         qp.drawRect(QtCore.QRectF(*self.pathgen.getArea()))
         
+        # The paths are drawn in reference coordinates, the pens scaled along
+        qp.setTransform(self.pathgen.referenceTransform())
+        pen.setWidthF(self.pathgen.reference_scale * self.pathgen.milling_params.tool_width)
+        pen2.setWidthF(self.pathgen.reference_scale * self.pathgen.milling_params.tool_width)
         if self.view.realistic_mode:
             brush = QtGui.QBrush(copper)
         else:
@@ -113,6 +124,7 @@ class PathPreview(QtWidgets.QWidget):
                 else:
                     qp.setBrush(brush)
             qp.drawPath(path)
+        qp.resetTransform()
         pen = QtGui.QPen(QtGui.QColor(192, 192, 192))
         pen.setStyle(0)
         for x, y, diameterx, diametery, net in self.drills:
@@ -135,3 +147,5 @@ class PathPreview(QtWidgets.QWidget):
 
     def sizeBoard(self):
         self.pathgen.sizeBoard()
+        # Drop the geometry of the previous board
+        self.geometry_cache.clear()
@@ -0,0 +1,125 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+sys.path += ['.']
+from cam.rdkic import KicadBoard
+from cam.mill import *
+from cam.pathcache import ToolpathCache
+
+# Headless batch version of the Export action of pcbf.py: generates the
+# isolation, drilling and edge cutting gcode for one or more boards.
+
+def layer_file_name(layer):
+    return {'B.Cu' : 'back', 'F.Cu' : 'front'}.get(layer, layer.replace('.', '_'))
+
+def export_board(args, fname, milling_params, cache):
+    with open(fname, "r") as f:
+        board = KicadBoard(f, streaming = True)
+    name = os.path.splitext(os.path.basename(fname))[0]
+    job = GcodeJob()
+    def output(suffix, operation, tool):
+        return job.add("%s-%s.nc" % (name, suffix), operation, tool = tool)
+    gc = output(layer_file_name(args.layer), EngravingOperation(), 1)
+    mill_contours(gc, board, args.layer, milling_params, cache = cache)
+    gc.end()
+    if args.clear:
+        gc = output("clear", ClearingOperation(), 3)
+        clear_copper(gc, board, args.layer, milling_params, cache = cache)
+        gc.end()
+    gc = output("drill", PeckDrillingOperation(), 2)
+    drill_holes_and_slots(gc, board, args.layer, milling_params, cache = cache)
+    gc.end()
+    if args.edge_layer in board.layers:
+        gc = output("cuts", EdgeCuttingOperation(), 2)
+        cut_edges(gc, board, args.edge_layer, milling_params, cache = cache)
+        gc.end()
+    outputs = []
+    if milling_params.simplify_tolerance > 0:
+        before, after = job.segment_counts()
+        outputs.append("[segments %d -> %d]" % (before, after))
+    if milling_params.tour_time > 0:
+        before, after = job.rapid_distances()
+        outputs.append("[rapids %0.1fmm -> %0.1fmm]" % (before, after))
+    if args.combined or args.no_separate:
+        outputs.append(os.path.join(args.output_dir, name + ".nc"))
+        job.save(outputs[-1], args.compress)
+    if not args.no_separate:
+        outputs += job.save_parts(args.output_dir, args.compress)
+    return outputs
+
+def process_board(task):
+    args, fname, milling_params = task
+    cache = None if args.no_cache else ToolpathCache(args.cache_dir)
+    start = time.time()
+    try:
+        outputs = export_board(args, fname, milling_params, cache)
+    except Exception as e:
+        return fname, None, "%s: %s" % (type(e).__name__, e), time.time() - start
+    return fname, outputs, None, time.time() - start
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description = "Generate gcode for KiCad boards without the GUI")
+    parser.add_argument("boards", nargs = "+", help = ".kicad_pcb files to process")
+    parser.add_argument("-o", "--output-dir", default = ".", help = "directory for the generated files (default: current directory)")
+    parser.add_argument("-l", "--layer", default = "B.Cu", help = "copper layer to isolate and drill (default: B.Cu)")
+    parser.add_argument("--edge-layer", default = "Edge.Cuts", help = "layer with the board outline (default: Edge.Cuts)")
+    parser.add_argument("--combined", action = "store_true", help = "write all the operations to <board>.nc, with tool changes")
+    parser.add_argument("--no-separate", action = "store_true", help = "only write the combined file, not each operation to its own file")
+    parser.add_argument("--compress", action = "store_true", help = "drop redundant words and moves and merge collinear moves")
+    parser.add_argument("-t", "--tool-width", type = float, default = MillingParams().tool_width, help = "isolation tool width in mm")
+    parser.add_argument("--double-isolation", action = "store_true", help = "add extra pass to widen isolation paths (one more pass with --passes > 1)")
+    parser.add_argument("-p", "--passes", type = int, default = 1, help = "number of isolation passes, the extra ones only where there is room for them (default: 1)")
+    parser.add_argument("--stepover", type = float, default = 0.5, help = "offset between isolation passes, in tool widths (default: 0.5)")
+    parser.add_argument("--clear", action = "store_true", help = "rough out the copper left between the isolation paths with an endmill (tool 3)")
+    parser.add_argument("--backend", choices = ("qt", "shapely"), default = "qt", help = "geometry backend")
+    parser.add_argument("--union", choices = ("incremental", "pairwise"), default = "incremental", help = "union strategy for net outlines")
+    parser.add_argument("--simplify", type = float, default = 0, help = "max deviation in mm when removing nearly collinear points from the contours (default: 0, keep all)")
+    parser.add_argument("--tour-time", type = float, default = 0, help = "seconds spent improving the order of each operation to shorten rapids (default: 0, greedy only)")
+    parser.add_argument("--group-holes", action = "store_true", help = "drill the holes ordered by size, smallest first (same tool, no tool changes)")
+    parser.add_argument("-j", "--jobs", type = int, default = 0, help = "number of boards processed in parallel (default: all cores)")
+    parser.add_argument("--no-cache", action = "store_true", help = "do not use the on-disk toolpath cache")
+    parser.add_argument("--cache-dir", default = None, help = "toolpath cache directory")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    milling_params = MillingParams()
+    milling_params.tool_width = args.tool_width
+    milling_params.doubleIsolation = args.double_isolation
+    milling_params.isolation_passes = args.passes
+    milling_params.isolation_stepover = args.stepover
+    milling_params.backend = args.backend
+    milling_params.union_strategy = args.union
+    milling_params.tour_time = args.tour_time
+    milling_params.group_holes = args.group_holes
+    milling_params.simplify_tolerance = args.simplify
+    jobs = args.jobs or multiprocessing.cpu_count()
+    jobs = min(jobs, len(args.boards))
+    if jobs == 1:
+        # Use the cores for per-net path generation instead
+        milling_params.processes = 0
+        results = map(process_board, [(args, fname, milling_params) for fname in args.boards])
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(process_board, [(args, fname, milling_params) for fname in args.boards])
+    failed = 0
+    try:
+        for fname, outputs, error, elapsed in results:
+            if error is not None:
+                failed += 1
+                print("%s: FAILED (%s)" % (fname, error))
+            else:
+                print("%s: %s (%0.1fs)" % (fname, " ".join(outputs), elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,526 @@
+import io
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+sys.path += ['.']
+from cam.rdkic import *
+from cam.mill import *
+from cam.mill import _convpt
+from cam.tour import rapid_distance
+from cam.gcode import GcodeOutputBase, CutSequence, Material, PocketingCut, ProfileCut, layerbylayer2, material_plywood_4mm, mill_ring, mill_shape
+
+# Generates synthetic .kicad_pcb boards and times the CAM pipeline on them.
+# Usage: python pcbbench.py [benchmark] [size]
+
+def generate_board(nsegments = 10000, nmodules = 500, nzones = 4, zone_points = 20000, nnets = 200, seed = 1):
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    w = out.write
+    width, height = 160.0, 100.0
+    w('(kicad_pcb (version 20171130) (host pcbnew "(5.1.9)")\n')
+    w('  (general (thickness 1.6) (drawings 4) (tracks %d) (zones %d) (modules %d) (nets %d))\n' % (nsegments, nzones, nmodules, nnets))
+    w('  (page A4)\n')
+    w('  (setup (last_trace_width 0.25) (trace_clearance 0.2)\n')
+    w('    (pcbplotparams (layerselection 0x010fc_ffffffff) (usegerberextensions false) (outputdirectory "gerber/")))\n')
+    w('  (net 0 "")\n')
+    w('  (net 1 GND)\n')
+    for n in range(2, nnets):
+        w('  (net %d "Net-(U%d-Pad1)")\n' % (n, n))
+    for m in range(nmodules):
+        x, y = rnd.uniform(5, width - 5), rnd.uniform(5, height - 5)
+        angle = rnd.choice([0, 90, 180, 270])
+        w('  (module Resistor_THT:R_Axial (layer F.Cu) (tedit 5AE5139B) (tstamp 5D%06X)\n' % m)
+        w('    (at %0.4f %0.4f %d)\n' % (x, y, angle))
+        w('    (fp_text reference R%d (at 0 -2) (layer F.SilkS) (effects (font (size 1 1) (thickness 0.15))))\n' % m)
+        for p in range(2):
+            w('    (pad %d thru_hole %s (at %0.2f 0 %d) (size 1.6 1.6) (drill 0.8) (layers *.Cu *.Mask) (net %d "N"))\n' % (p + 1, rnd.choice(['circle', 'rect', 'oval']), p * 2.54, angle, rnd.randrange(1, nnets)))
+        w('    (pad 3 smd rect (at 1.27 1.5 %d) (size 1.2 0.6) (layers B.Cu B.Paste B.Mask) (net %d "N"))\n' % (angle, rnd.randrange(1, nnets)))
+        w('  )\n')
+    for c in [((0, 0), (width, 0)), ((width, 0), (width, height)), ((width, height), (0, height)), ((0, height), (0, 0))]:
+        w('  (gr_line (start %0.4f %0.4f) (end %0.4f %0.4f) (layer Edge.Cuts) (width 0.05) (tstamp 5D000000))\n' % (c[0][0], c[0][1], c[1][0], c[1][1]))
+    for s in range(nsegments):
+        x, y = rnd.uniform(1, width - 1), rnd.uniform(1, height - 1)
+        angle = rnd.choice([0, 45, 90, 135]) * math.pi / 180
+        l = rnd.uniform(0.5, 5)
+        w('  (segment (start %0.4f %0.4f) (end %0.4f %0.4f) (width 0.25) (layer %s) (net %d) (tstamp 5D%06X))\n' % (x, y, x + l * math.cos(angle), y + l * math.sin(angle), rnd.choice(['F.Cu', 'B.Cu']), rnd.randrange(1, nnets), s))
+    for z in range(nzones):
+        cx, cy = rnd.uniform(20, width - 20), rnd.uniform(20, height - 20)
+        r = rnd.uniform(5, 15)
+        w('  (zone (net 1) (net_name GND) (layer B.Cu) (tstamp 0) (hatch edge 0.508)\n')
+        w('    (connect_pads (clearance 0.508))\n')
+        w('    (min_thickness 0.254)\n')
+        w('    (fill yes (arc_segments 32) (thermal_gap 0.508) (thermal_bridge_width 0.508))\n')
+        w('    (polygon (pts (xy %0.4f %0.4f) (xy %0.4f %0.4f) (xy %0.4f %0.4f)))\n' % (cx - r, cy - r, cx + r, cy - r, cx + r, cy + r))
+        w('    (filled_polygon\n      (pts\n')
+        for i in range(zone_points):
+            a = 2 * math.pi * i / zone_points
+            rr = r * (1 + 0.05 * math.sin(37 * a))
+            w('        (xy %0.4f %0.4f)\n' % (cx + rr * math.cos(a), cy + rr * math.sin(a)))
+        w('      )\n    )\n  )\n')
+    w(')\n')
+    return out.getvalue()
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+def measure(func):
+    # Timing is done separately, tracemalloc slows down the allocations a lot
+    result, elapsed = timed(func)
+    result = None
+    tracemalloc.start()
+    result = func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def board_summary(board):
+    res = [board.version, board.host, board.host_version, board.page, sorted(board.nets.items())]
+    for name in sorted(board.layers):
+        l = board.layers[name]
+        res.append((name,
+            [(s.start, s.end, s.width, s.net) for s in l.segments],
+            [(p.x, p.y, p.w, p.h, p.shape, p.pad_type, p.net, p.drillx, p.drilly) for p in l.pads],
+            [(g.start, g.end, g.width) for g in l.gr_lines],
+            sorted((net, [list(p) for p in polys]) for net, polys in l.polygons.items())))
+    return res
+
+def bench_loader(size):
+    data = generate_board(nsegments = 10000 * size, nmodules = 500 * size, zone_points = 20000 * size)
+    print("Board size: %0.1f MB" % (len(data) / 1048576.0))
+    board1, t1, m1 = measure(lambda: KicadBoard(io.StringIO(data)))
+    print("sexpdata loader:  %0.2fs, peak %0.1f MB" % (t1, m1 / 1048576.0))
+    board2, t2, m2 = measure(lambda: KicadBoard(io.StringIO(data), streaming = True))
+    print("streaming loader: %0.2fs, peak %0.1f MB" % (t2, m2 / 1048576.0))
+    if board_summary(board1) != board_summary(board2):
+        print("ERROR: boards differ")
+
+# The original per-point implementation, kept for comparison
+def legacy_size_board(board):
+    sizer = BoardSizer(None)
+    for l in list(board.layers.values()):
+        for seg in l.segments:
+            sizer.addPointToBB(seg.start)
+            sizer.addPointToBB(seg.end)
+        for seg in l.gr_lines:
+            sizer.addPointToBB(seg.start)
+            sizer.addPointToBB(seg.end)
+        for net, polygons in list(l.polygons.items()):
+            for p in polygons:
+                for pt in p:
+                    sizer.addPointToBB(pt)
+    return sizer.minpt, sizer.maxpt
+
+def bench_sizer(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 10000 * size, nmodules = 500 * size, zone_points = 50000 * size)), streaming = True)
+    ref, t1 = timed(lambda: legacy_size_board(board))
+    print("per-point sizing: %0.3fs" % t1)
+    sizer, t2 = timed(lambda: BoardSizer(board))
+    print("bulk sizing:      %0.3fs" % t2)
+    sizer, t3 = timed(lambda: BoardSizer(board))
+    print("cached sizing:    %0.3fs" % t3)
+    if (sizer.minpt, sizer.maxpt) != ref:
+        print("ERROR: extents differ: %s vs %s" % ((sizer.minpt, sizer.maxpt), ref))
+
+def bench_nets(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 4000 * size, nmodules = 200 * size, zone_points = 2000, nnets = 300)), streaming = True)
+    view = isolation_view(board)
+    for processes in (1, 0):
+        params = MillingParams()
+        params.processes = processes
+        (paths, drills), t = timed(lambda: PathGenerator(view, params).generatePathsForLayer("B.Cu"))
+        print("%s: %d nets in %0.2fs" % ("sequential" if processes == 1 else "process pool", len(paths), t))
+
+def generate_gnd_board(ntracks):
+    # One huge GND net made of a grid of crossing tracks
+    out = io.StringIO()
+    w = out.write
+    w('(kicad_pcb (version 20171130) (host pcbnew "(5.1.9)")\n  (net 0 "")\n  (net 1 GND)\n')
+    n = max(1, int(ntracks ** 0.5 / 2))
+    for i in range(ntracks):
+        k = (i // 2) % n
+        a = (i // (2 * n)) * 0.7
+        if i % 2:
+            w('  (segment (start %0.4f 0) (end %0.4f 30) (width 0.25) (layer B.Cu) (net 1))\n' % (k * 1.5 + a, k * 1.5 + a))
+        else:
+            w('  (segment (start 0 %0.4f) (end 30 %0.4f) (width 0.25) (layer B.Cu) (net 1))\n' % (k * 1.5 + a, k * 1.5 + a))
+    w(')\n')
+    return out.getvalue()
+
+def bench_union(size):
+    for ntracks in (250 * size, 500 * size, 1000 * size):
+        board = KicadBoard(io.StringIO(generate_gnd_board(ntracks)), streaming = True)
+        view = isolation_view(board)
+        for strategy in ('incremental', 'pairwise'):
+            params = MillingParams()
+            params.union_strategy = strategy
+            result, t = timed(lambda: PathGenerator(view, params).generatePathsForLayer("B.Cu"))
+            print("GND net with %d tracks, %s union: %0.2fs" % (ntracks, strategy, t))
+
+def bench_backend(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 4000 * size, nmodules = 200 * size, zone_points = 5000, nnets = 100)), streaming = True)
+    view = isolation_view(board)
+    for backend in ('qt', 'shapely'):
+        params = MillingParams()
+        params.backend = backend
+        pp = make_path_generator(view, params)
+        (paths, drills), t = timed(lambda: pp.generatePathsForLayer("B.Cu"))
+        ncontours = sum(len(pp.pathToContours(p)) for p in paths.values())
+        print("%s backend: %d nets, %d contours in %0.2fs" % (backend, len(paths), ncontours, t))
+
+def legacy_optimize_paths(paths):
+    newpaths = paths[0:1]
+    paths = paths[1:]
+    while len(paths) > 0:
+        lastpt = newpaths[-1][-1]
+        pt = paths[0][0]
+        mindist2 = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
+        minp = 0
+        minpt = 0
+        for p in range(len(paths)):
+            for ptidx in range(0, len(paths[p])):
+                pt = paths[p][ptidx]
+                dist2 = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
+                if dist2 < mindist2:
+                    mindist2 = dist2
+                    minpt = ptidx
+                    minp = p
+        p = paths[minp]
+        if minpt > 0:
+            newpaths.append(p[minpt:] + p[:minpt])
+        else:
+            newpaths.append(p)
+        paths[minp:minp + 1] = []
+    return newpaths
+
+def generate_contours(ncontours, npoints = 24, seed = 1):
+    rnd = random.Random(seed)
+    side = (ncontours ** 0.5) * 3.0
+    contours = []
+    for c in range(ncontours):
+        cx, cy = rnd.uniform(0, side), rnd.uniform(0, side)
+        r = rnd.uniform(0.3, 1.2)
+        contours.append([(cx + r * math.cos(2 * math.pi * i / npoints), cy + r * math.sin(2 * math.pi * i / npoints)) for i in range(npoints)])
+    return contours
+
+def rapid_length(paths):
+    total = 0
+    for i in range(1, len(paths)):
+        a, b = paths[i - 1][-1], paths[i][0]
+        total += ((a[0] - b[0])**2 + (a[1] - b[1])**2) ** 0.5
+    return total
+
+def bench_ordering(size):
+    contours = generate_contours(1000)
+    ref, t1 = timed(lambda: legacy_optimize_paths(list(contours)))
+    res, t2 = timed(lambda: optimize_paths(list(contours)))
+    print("1000 contours: full scan %0.2fs, grid %0.2fs, rapids %0.1fmm" % (t1, t2, rapid_length(res)))
+    if ref != res:
+        print("ERROR: orderings differ")
+    contours = generate_contours(10000 * size)
+    res, t = timed(lambda: optimize_paths(contours))
+    print("%d contours: grid %0.2fs, rapids %0.1fmm (unordered %0.1fmm)" % (len(contours), t, rapid_length(res), rapid_length(contours)))
+
+def bench_tour(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 2000 * size, nmodules = 300 * size, zone_points = 500, nnets = 100)), streaming = True)
+    for tour_time in (0, 2, 10):
+        params = MillingParams()
+        params.backend = 'shapely'
+        params.tour_time = tour_time
+        print("tour time %ds:" % tour_time)
+        contour_rapids, hole_rapids = [0.0, 0.0], [0.0, 0.0]
+        (pathlist, openlist), t1 = timed(lambda: contour_toolpaths(board, "B.Cu", params, rapids = contour_rapids))
+        holes, t2 = timed(lambda: hole_toolpaths(board, "B.Cu", params, rapids = hole_rapids))
+        if not tour_time:
+            starts = [p[0] for p in pathlist]
+            centres = [h[0:2] for h in holes]
+            contour_rapids = [rapid_distance((0, 0), starts, starts)] * 2
+            hole_rapids = [rapid_distance((0, 0), centres, centres)] * 2
+        print("  contours %d (%0.1fs, rapids %0.1fmm -> %0.1fmm), holes %d (%0.1fs, rapids %0.1fmm -> %0.1fmm)" % ((len(pathlist), t1) + tuple(contour_rapids) + (len(holes), t2) + tuple(hole_rapids)))
+
+def legacy_order_holes(holes):
+    holes = list(holes)
+    sorted_holes = []
+    lastpt = (0, 0)
+    while len(holes) > 0:
+        min_dist = None
+        for h in range(len(holes)):
+            pt = holes[h]
+            dist = (pt[0] - lastpt[0])**2 + (pt[1] - lastpt[1])**2
+            if min_dist is None or dist < min_dist:
+                min_hole = h
+                min_dist = dist
+        sorted_holes.append(holes[min_hole])
+        lastpt = holes[min_hole][0:2]
+        holes = holes[:min_hole] + holes[min_hole + 1:]
+    return sorted_holes
+
+def bench_holes(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 100, nmodules = 2500 * size, nzones = 0, nnets = 100)), streaming = True)
+    params = MillingParams()
+    view = isolation_view(board, "B.Cu")
+    pp = make_path_generator(view, params)
+    holes = [_convpt((x, y), view, pp.sizer) + (drillx, drilly) for x, y, drillx, drilly, net in pp.collectDrills(board.layers["B.Cu"].pads)]
+    ref, t1 = timed(lambda: legacy_order_holes(holes))
+    res, t2 = timed(lambda: hole_toolpaths(board, "B.Cu", params))
+    print("%d holes: full scan %0.2fs, grid %0.2fs" % (len(holes), t1, t2))
+    if ref != res:
+        print("ERROR: orderings differ")
+
+def legacy_cmpguess(g1, g2, tol = 0.02, stol = 0.1):
+    if g1 is None or g2 is None:
+        return False
+    c1, r1, s1 = g1
+    c2, r2, s2 = g2
+    d = QtCore.QLineF(c1, c2)
+    if d.length() > tol:
+        return False
+    dr = abs(r1 - r2)
+    if dr > tol:
+        return False
+    if max(s1, s2) > max(stol, 2 * math.pi * max(r1, r2) / 5):
+        return False
+    return True
+
+def legacy_path_to_optimized_gcode(gc, points, closed = True):
+    guesses = []
+    for i in range(len(points)):
+        if i + 2 >= len(points):
+            guesses.append(None)
+            continue
+        p1 = QtCore.QPointF(*points[i])
+        p2 = QtCore.QPointF(*points[i + 1])
+        p3 = QtCore.QPointF(*points[i + 2])
+        l1 = QtCore.QLineF(p1, p2)
+        l2 = QtCore.QLineF(p2, p3)
+        n1 = l1.normalVector().translated(l1.dx() / 2, l1.dy() / 2)
+        n2 = l2.normalVector().translated(l2.dx() / 2, l2.dy() / 2)
+        centre = QtCore.QPointF(0, 0)
+        if n1.intersect(n2, centre) > 0:
+            r = QtCore.QLineF(p1, centre).length()
+            step = max(l1.length(), l2.length())
+            if r > 0.1:
+                guesses.append((centre, r, step))
+            else:
+                guesses.append(None)
+        else:
+            guesses.append(None)
+    gc.move_to(points[0][0], points[0][1])
+    i = 1
+    while i < len(points):
+        if i + 1 < len(points) and legacy_cmpguess(guesses[i - 1], guesses[i]):
+            j = i
+            while j < len(points) and legacy_cmpguess(guesses[i - 1], guesses[j + 1]):
+                j += 1
+            cx = sum([guesses[k][0].x() for k in range(i - 1, j)]) / (j - i + 1)
+            cy = sum([guesses[k][0].y() for k in range(i - 1, j)]) / (j - i + 1)
+            r = sum([guesses[k][1] for k in range(i - 1, j)]) / (j - i + 1)
+            start = calign(points[i - 1], cx, cy, r)
+            end = calign(points[j + 2], cx, cy, r)
+            gc.arc_cw_to(x = end[0], y = end[1], i = cx - start[0], j = cy - start[1])
+            i = j + 3
+        else:
+            gc.line_to(points[i][0], points[i][1])
+            i += 1
+    if closed:
+        gc.line_to(points[0][0], points[0][1])
+
+class RecordingOutput(GcodeOutputBase):
+    def __init__(self, operation):
+        GcodeOutputBase.__init__(self, operation = operation)
+        self.lines = []
+    def write(self, line):
+        self.lines.append(line)
+
+def bench_arcs(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 1000 * size, nmodules = 300 * size, zone_points = 500, nnets = 100)), streaming = True)
+    pathlist, openlist = contour_toolpaths(board, "B.Cu", MillingParams())
+    print("%d contours, %d points" % (len(pathlist), sum(len(p) for p in pathlist)))
+    ref, res = RecordingOutput(EngravingOperation()), RecordingOutput(EngravingOperation())
+    t1 = timed(lambda: [legacy_path_to_optimized_gcode(ref, p) for p in pathlist])[1]
+    t2 = timed(lambda: [emit_moves(res, m) for m in fit_arcs_many(pathlist)])[1]
+    print("Qt lines %0.2fs, numpy %0.2fs, %d arcs" % (t1, t2, sum(1 for l in res.lines if l.startswith("G2"))))
+    if ref.lines != res.lines:
+        print("ERROR: gcode differs")
+
+class DeepEngravingOperation(EngravingOperation):
+    zdepth = -0.4
+
+def legacy_mill_contours(gc, pathlist):
+    depth = 0
+    while depth > gc.operation.zdepth:
+        depth = max(depth - abs(gc.operation.zstep), gc.operation.zdepth)
+        gc.zdepth = depth
+        gc.get_safe()
+        for p in pathlist:
+            path_to_optimized_gcode(gc, p)
+
+def bench_passes(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 1000 * size, nmodules = 300 * size, zone_points = 500, nnets = 100)), streaming = True)
+    params = MillingParams()
+    pathlist, openlist = contour_toolpaths(board, "B.Cu", params)
+    ref, res = RecordingOutput(DeepEngravingOperation()), RecordingOutput(DeepEngravingOperation())
+    t1 = timed(lambda: legacy_mill_contours(ref, pathlist))[1]
+    t2 = timed(lambda: mill_contours(res, board, "B.Cu", params))[1]
+    print("4 passes, %d contours: per pass %0.2fs, replayed %0.2fs (incl. %0.2fs for the contours)" % (len(pathlist), t1, t2, timed(lambda: contour_toolpaths(board, "B.Cu", params))[1]))
+    if ref.lines != res.lines:
+        print("ERROR: gcode differs")
+
+class LegacyGcodeOutput(GcodeOutputBase):
+    def __init__(self, filename, operation):
+        GcodeOutputBase.__init__(self, operation = operation)
+        self.f = open(filename, "w")
+        self.preamble()
+    def write(self, line):
+        self.f.write(line + "\n")
+    def end(self):
+        GcodeOutputBase.end(self)
+        self.f.close()
+
+def bench_writer(size):
+    contours = generate_contours(20000 * size)
+    toolpath = Toolpath()
+    for c in contours:
+        path_to_optimized_gcode(toolpath, c)
+    def write(gc):
+        for depth in (-0.1, -0.2, -0.3, -0.4):
+            gc.set_depth(depth)
+            gc.emit_toolpath(toolpath)
+        gc.end()
+        return gc
+    def best(func):
+        return min(timed(func)[1] for i in range(3))
+    fname = tempfile.mktemp(suffix = ".nc")
+    try:
+        t1 = best(lambda: write(LegacyGcodeOutput(fname, DeepEngravingOperation())))
+        ref = open(fname).read()
+        t2 = best(lambda: write(GcodeOutput(fname, DeepEngravingOperation())))
+        res = open(fname).read()
+    finally:
+        os.unlink(fname)
+    t3 = best(lambda: write(GcodeBuffer(DeepEngravingOperation())))
+    buf = write(GcodeBuffer(DeepEngravingOperation()))
+    print("%d lines: per line %0.2fs, blocks %0.2fs, in memory %0.2fs" % (ref.count("\n"), t1, t2, t3))
+    if ref != res or ref != buf.getvalue():
+        print("ERROR: outputs differ")
+
+def bench_compress(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 1000 * size, nmodules = 300 * size, zone_points = 500, nnets = 100)), streaming = True)
+    params = MillingParams()
+    for name, operation, func in (("contours", EngravingOperation(), mill_contours), ("holes", PeckDrillingOperation(), drill_holes_and_slots)):
+        gc = GcodeBuffer(operation)
+        func(gc, board, "B.Cu", params)
+        gc.end()
+        plain = gc.getvalue()
+        compressed, t = timed(lambda: gc.getvalue(compress = True))
+        print("%s: %d -> %d lines, %d -> %d bytes (%0.2fs)" % (name, plain.count("\n"), compressed.count("\n"), len(plain), len(compressed), t))
+
+def bench_simplify(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 1000 * size, nmodules = 300 * size, zone_points = 5000, nnets = 100)), streaming = True)
+    for tolerance in (0, 0.002, 0.005, 0.01):
+        params = MillingParams()
+        params.simplify_tolerance = tolerance
+        gc = GcodeBuffer(EngravingOperation())
+        t = timed(lambda: mill_contours(gc, board, "B.Cu", params))[1]
+        print("tolerance %0.3fmm: %d lines (%0.2fs)" % (tolerance, len(gc.lines), t))
+
+def bench_isolation(size):
+    board = KicadBoard(io.StringIO(generate_board(nsegments = 3000 * size, nmodules = 300 * size, zone_points = 300, nnets = 100)), streaming = True)
+    for backend in ('qt', 'shapely'):
+        params = MillingParams()
+        params.backend = backend
+        params.doubleIsolation = True
+        (pathlist, openlist), t = timed(lambda: contour_toolpaths(board, "B.Cu", params))
+        print("%s double isolation: %d contours, %d points (%0.2fs)" % (backend, len(pathlist), sum(len(p) for p in pathlist), t))
+        for passes in (1, 2, 3, 4):
+            params = MillingParams()
+            params.backend = backend
+            params.isolation_passes = passes
+            (pathlist, openlist), t = timed(lambda: contour_toolpaths(board, "B.Cu", params))
+            print("%s %d passes: %d contours, %d pieces, %d points (%0.2fs)" % (backend, passes, len(pathlist), len(openlist), sum(len(p) for p in pathlist + openlist), t))
+
+# Plate with round islands to pocket around
+def generate_pocket(nislands, seed = 1):
+    rnd = random.Random(seed)
+    shape = shapely.geometry.box(0, 0, 200, 120)
+    for i in range(nislands):
+        shape = shape.difference(shapely.geometry.Point(rnd.uniform(10, 190), rnd.uniform(10, 110)).buffer(rnd.uniform(2, 8)))
+    return shape
+
+# mill_poly before the offset cascade: the milled area is subtracted after
+# every ring, for every layer
+def legacy_mill_poly(gc, p, tool):
+    p = p.buffer(-tool * 0.5, quad_segs = 30, cap_style = 2, join_style = 2, mitre_limit = 0.1)
+    while not p.is_empty:
+        milled = mill_shape(gc, p, tool)
+        if milled.is_empty:
+            break
+        p = p.difference(milled)
+
+def bench_pocketing(size):
+    shape = generate_pocket(10 * size)
+    material = material_plywood_4mm
+    safe = "G0Z%0.3f" % material.safe_z
+    gc = GcodeBuffer(material = material, tool = 3.0)
+    t = timed(lambda: layerbylayer2(gc, lambda gc: legacy_mill_poly(gc, shape, 3.0), material.layer_depth, material.get_final_depth(), material.get_init_depth()))[1]
+    print("legacy: %d lines, %d retracts (%0.2fs)" % (len(gc.lines), gc.lines.count(safe), t))
+    for linked in (False, True):
+        gc = GcodeBuffer(material = material, tool = 3.0)
+        t = timed(lambda: PocketingCut(shape, linked = linked).run(gc))[1]
+        print("linked %s: %d lines, %d retracts (%0.2fs)" % (linked, len(gc.lines), gc.lines.count(safe), t))
+
+# ProfileCut.run before the toolpaths were built once: the ring is formatted
+# again for every layer
+def legacy_profile_run(cut, gc):
+    p = cut.shape.buffer(cut.tool_location * gc.tool / 2.0).exterior
+    layerbylayer2(gc, lambda gc: mill_ring(gc, p), gc.material.layer_depth, cut.get_final_depth(gc.material), cut.get_init_depth(gc.material))
+
+def bench_cuts(size):
+    rnd = random.Random(1)
+    material = Material(thickness = 10.0, layer_depth = 0.5, feed = 500, plunge = 200)
+    seq = CutSequence()
+    for i in range(200 * size):
+        seq.add(ProfileCut.hole(rnd.uniform(0, 300), rnd.uniform(0, 300), rnd.uniform(5, 20)))
+    gc = GcodeBuffer(material = material, tool = 2.0)
+    t = timed(lambda: [legacy_profile_run(cut, gc) for cut in seq.cuts])[1]
+    print("legacy: %d lines (%0.2fs)" % (len(gc.lines), t))
+    for run in ("first", "second"):
+        res = GcodeBuffer(material = material, tool = 2.0)
+        t = timed(lambda: seq.run(res))[1]
+        print("%s run: %d lines (%0.2fs)" % (run, len(res.lines), t))
+    if res.lines != gc.lines:
+        print("ERROR: gcode differs")
+
+benchmarks = {
+    'loader' : bench_loader,
+    'sizer' : bench_sizer,
+    'nets' : bench_nets,
+    'union' : bench_union,
+    'backend' : bench_backend,
+    'ordering' : bench_ordering,
+    'tour' : bench_tour,
+    'holes' : bench_holes,
+    'arcs' : bench_arcs,
+    'passes' : bench_passes,
+    'writer' : bench_writer,
+    'compress' : bench_compress,
+    'simplify' : bench_simplify,
+    'isolation' : bench_isolation,
+    'pocketing' : bench_pocketing,
+    'cuts' : bench_cuts,
+}
+
+def main():
+    names = sys.argv[1:2] or sorted(benchmarks.keys())
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    for name in names:
+        print("--- %s" % name)
+        benchmarks[name](size)
+
+if __name__ == '__main__':
+    main()
@@ -5,29 +5,45 @@ from PyQt5 import QtCore, QtGui, QtWidgets
 from cam.rdkic import *
 from helpers.preview import PathPreview
 from cam.mill import *
+from cam.pathcache import ToolpathCache
 from helpers.gui import MenuHelper
 
 class CAMApplication(QtWidgets.QApplication):
     pass
 
 class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
-    def __init__(self):
+    def __init__(self, cache = None):
         QtWidgets.QMainWindow.__init__(self)
         MenuHelper.__init__(self)
         self.milling_params = MillingParams()
+        self.cache = cache
+        # Also write each operation to its own file on export
+        self.separate_files = True
+        # Pass the exported gcode through compress_gcode
+        self.compress_gcode = False
+        # Rough out the copper between the isolation paths with an endmill
+        self.clear_copper = False
         self.initUI()
     
     def exportGcode(self, board):
-        engraving = EngravingOperation()
-        gc = GcodeOutput("back.nc", engraving)
-        mill_contours(gc, board, "B.Cu", self.milling_params)
+        job = GcodeJob()
+        gc = job.add("back.nc", EngravingOperation(), tool = 1)
+        mill_contours(gc, board, "B.Cu", self.milling_params, cache = self.cache)
         gc.end()
-        gc = GcodeOutput("drill.nc", PeckDrillingOperation())
-        drill_holes_and_slots(gc, board, "B.Cu", self.milling_params)
+        if self.clear_copper:
+            gc = job.add("clear.nc", ClearingOperation(), tool = 3)
+            clear_copper(gc, board, "B.Cu", self.milling_params, cache = self.cache)
+            gc.end()
+        gc = job.add("drill.nc", PeckDrillingOperation(), tool = 2)
+        drill_holes_and_slots(gc, board, "B.Cu", self.milling_params, cache = self.cache)
         gc.end()
-        gc = GcodeOutput("cuts.nc", EdgeCuttingOperation())
-        cut_edges(gc, board, "Edge.Cuts", self.milling_params)
+        gc = job.add("cuts.nc", EdgeCuttingOperation(), tool = 2)
+        cut_edges(gc, board, "Edge.Cuts", self.milling_params, cache = self.cache)
         gc.end()
+        tools = [self.milling_params.tool_width, PeckDrillingOperation().endmill_dia]
+        if self.clear_copper:
+            tools.append(ClearingOperation().endmill_dia)
+        tooltable = "\n".join("    <tool length='10' number='%d' radius='%f' shape='CYLINDRICAL' units='MM'/>" % (i + 1, dia / 2.0) for i, dia in enumerate(tools))
         sizer = BoardSizer(self.view.board)
         bsizex = abs(sizer.maxpt[0] - sizer.minpt[0] + 1.6)
         bsizey = abs(sizer.maxpt[1] - sizer.minpt[1] + 1.6)
@@ -47,21 +63,23 @@ class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
   <workpiece-min v='(-1.6,-1.6,-1.6)'/>
 
   <tool_table>
-    <tool length='10' number='1' radius='%f' shape='CYLINDRICAL' units='MM'/>
-    <tool length='10' number='2' radius='%f' shape='CYLINDRICAL' units='MM'/>
+%s
   </tool_table>
 </openscam>
-    ''' % (self.milling_params.tool_width / 2.0, bsizex, bsizey, self.milling_params.tool_width / 2.0, PeckDrillingOperation().endmill_dia / 2.0)
-        file("pcb.openscam", "w").write(scamfile)
-        f = file("pcb.nc", "w")
-        f.write("M6 T1\n")
-        f.write(file("back.nc", "r").read())
-        f.write("M6 T2\n")
-        f.write(file("drill.nc", "r").read())
-        f.write(file("cuts.nc", "r").read())
-        f.close()
-        msgbox = QtGui.QMessageBox()
-        msgbox.setText("Board files (back.nc cuts.nc drill.nc) generated, width=%0.1fmm height=%0.1fmm" % (bsizex, bsizey))
+    ''' % (self.milling_params.tool_width / 2.0, bsizex, bsizey, tooltable)
+        with open("pcb.openscam", "w") as f:
+            f.write(scamfile)
+        job.save("pcb.nc", self.compress_gcode)
+        files = ["pcb.nc"]
+        if self.separate_files:
+            files += job.save_parts(compress = self.compress_gcode)
+        text = "Board files (%s) generated, width=%0.1fmm height=%0.1fmm" % (" ".join(files), bsizex, bsizey)
+        if self.milling_params.simplify_tolerance > 0:
+            text += ", %d segments simplified to %d" % tuple(job.segment_counts())
+        if self.milling_params.tour_time > 0:
+            text += ", rapids shortened from %0.1fmm to %0.1fmm" % tuple(job.rapid_distances())
+        msgbox = QtWidgets.QMessageBox()
+        msgbox.setText(text)
         msgbox.exec_()
     
     def hasBoard(self):
@@ -79,13 +97,16 @@ class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
     def initUI(self):
         self.view = ViewParams()
         if len(sys.argv) > 1:
-            self.view.board = KicadBoard(open(sys.argv[1], "r"))
+            self.view.board = KicadBoard(open(sys.argv[1], "r"), streaming = True)
                 
         self.w = PathPreview(self.view, self.milling_params)
         menuBar = self.menuBar()
         fileMenu = menuBar.addMenu("&File")
         fileMenu.addAction(self.makeAction("&Open", "Ctrl+O", "Open a file", self.onFileOpen))
-        fileMenu.addAction(self.requiresBoard(self.makeAction("&Export", "Ctrl+E", "Export gcode to a series of files", self.onFileExport)))
+        fileMenu.addAction(self.requiresBoard(self.makeAction("&Export", "Ctrl+E", "Export gcode to pcb.nc (and a series of files)", self.onFileExport)))
+        fileMenu.addAction(self.makeCheckAction("&Separate files", "", "Also export each operation to its own file (back.nc, drill.nc, cuts.nc)", self.onFileSeparateFiles, lambda: self.separate_files))
+        fileMenu.addAction(self.makeCheckAction("&Compress gcode", "", "Drop redundant words and moves, merge collinear moves (smaller files)", self.onFileCompress, lambda: self.compress_gcode))
+        fileMenu.addAction(self.makeCheckAction("C&lear copper", "", "Also export the roughing of the copper left between the isolation paths, with a %0.1fmm endmill (clear.nc)" % ClearingOperation().endmill_dia, self.onFileClearCopper, lambda: self.clear_copper))
         fileMenu.addAction(self.makeAction("E&xit", "Ctrl+Q", "Exit the application", self.close))
 
         viewMenu = menuBar.addMenu("&View")
@@ -108,7 +129,15 @@ class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
         toolpathMenu.addAction(self.makeRadioAction("0.&2mm", "Ctrl+2", "Set milling diameter to 0.2mm", group, lambda: self.onToolDiameter(0.2), lambda: self.milling_params.tool_width == 0.2))
         toolpathMenu.addAction(self.makeRadioAction("0.&3mm", "Ctrl+3", "Set milling diameter to 0.3mm", group, lambda: self.onToolDiameter(0.3), lambda: self.milling_params.tool_width == 0.3))
         toolpathMenu.addAction(self.makeSeparator())
-        toolpathMenu.addAction(self.makeCheckAction("&Double isolation", "", "Add extra pass to widen isolation paths (slow!)", self.onToolDouble, lambda: self.milling_params.doubleIsolation))
+        group = QtWidgets.QActionGroup(self)
+        toolpathMenu.addAction(self.makeRadioAction("Single isolation pass", "", "Mill one isolation path around each net", group, lambda: self.onToolPasses(1), lambda: self.milling_params.isolation_passes == 1))
+        toolpathMenu.addAction(self.makeRadioAction("2 isolation passes", "", "Mill 2 isolation paths around each net, where there is room for them", group, lambda: self.onToolPasses(2), lambda: self.milling_params.isolation_passes == 2))
+        toolpathMenu.addAction(self.makeRadioAction("3 isolation passes", "", "Mill 3 isolation paths around each net, where there is room for them", group, lambda: self.onToolPasses(3), lambda: self.milling_params.isolation_passes == 3))
+        toolpathMenu.addAction(self.makeRadioAction("4 isolation passes", "", "Mill 4 isolation paths around each net, where there is room for them", group, lambda: self.onToolPasses(4), lambda: self.milling_params.isolation_passes == 4))
+        toolpathMenu.addAction(self.makeCheckAction("&Double isolation", "", "Add extra pass to widen isolation paths, one more with several isolation passes (slow!)", self.onToolDouble, lambda: self.milling_params.doubleIsolation))
+        toolpathMenu.addAction(self.makeCheckAction("&Simplify paths", "", "Remove nearly collinear points (within 0.005mm) from the isolation paths", self.onToolSimplify, lambda: self.milling_params.simplify_tolerance > 0))
+        toolpathMenu.addAction(self.makeCheckAction("Improve &ordering", "", "Spend up to 2s per operation shortening the rapids between the cuts", self.onToolImproveOrdering, lambda: self.milling_params.tour_time > 0))
+        toolpathMenu.addAction(self.makeCheckAction("&Pairwise union", "", "Merge the outlines of each net in pairs (faster for large nets)", self.onToolPairwiseUnion, lambda: self.milling_params.union_strategy == 'pairwise'))
         
         self.coordLabel = QtWidgets.QLabel("")
         self.statusBar().insertPermanentWidget(0, self.coordLabel)
@@ -124,10 +153,22 @@ class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
     def onFileExport(self):
         self.exportGcode(self.view.board)
         
+    def onFileSeparateFiles(self):
+        self.separate_files = not self.separate_files
+        self.updateActions()
+
+    def onFileCompress(self):
+        self.compress_gcode = not self.compress_gcode
+        self.updateActions()
+
+    def onFileClearCopper(self):
+        self.clear_copper = not self.clear_copper
+        self.updateActions()
+
     def onFileOpen(self):
         fname, ffilter = QtWidgets.QFileDialog.getOpenFileName(self, 'Open file', '.', "Kicad PCB files (*.kicad_pcb)")
         if fname != '':
-            self.setBoard(KicadBoard(open(fname, "r")))
+            self.setBoard(KicadBoard(open(fname, "r"), streaming = True))
         
     def onViewLayer(self, layer):
         self.view.cur_layer = layer
@@ -165,14 +206,39 @@ class CAMMainWindow(QtWidgets.QMainWindow, MenuHelper):
         self.w.recalcAndRepaint()
         self.updateActions()
     
+    def onToolPasses(self, passes):
+        self.milling_params.isolation_passes = passes
+        self.w.recalcAndRepaint()
+        self.updateActions()
+
     def onToolDouble(self):
         self.milling_params.doubleIsolation = not self.milling_params.doubleIsolation
         self.w.recalcAndRepaint()
         self.updateActions()
+
+    def onToolSimplify(self):
+        self.milling_params.simplify_tolerance = 0 if self.milling_params.simplify_tolerance > 0 else 0.005
+        self.updateActions()
+
+    def onToolImproveOrdering(self):
+        self.milling_params.tour_time = 0 if self.milling_params.tour_time > 0 else 2
+        self.updateActions()
+
+    def onToolPairwiseUnion(self):
+        if self.milling_params.union_strategy == 'pairwise':
+            self.milling_params.union_strategy = 'incremental'
+        else:
+            self.milling_params.union_strategy = 'pairwise'
+        self.w.recalcAndRepaint()
+        self.updateActions()
     
 def main():    
+    # --no-cache: always recompute the toolpaths on export
+    use_cache = '--no-cache' not in sys.argv
+    if not use_cache:
+        sys.argv.remove('--no-cache')
     app = CAMApplication(sys.argv)
-    w = CAMMainWindow()
+    w = CAMMainWindow(ToolpathCache() if use_cache else None)
     w.show()
     
     sys.exit(app.exec_())
@@ -0,0 +1,14 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from cam.compress import compress_gcode
+
+def test_full_circle_arc_keeps_endpoint():
+    lines = ["G90 G17", "G0Z0.800", "G0X111.908Y6.510", "G1Z-0.100F400", "G2X111.908Y6.510I0.950J-0.000F800"]
+    result = compress_gcode(lines)
+    arc = [line for line in result if line.startswith("G2")]
+    assert arc == ["G2X111.908Y6.510I0.950J-0.000F800"]
+
+def test_unchanged_axes_dropped_on_lines():
+    result = compress_gcode(["G90 G17", "G0X1.000Y2.000Z0.800", "G1X1.000Y3.000Z-0.100F400", "G1X2.000Y3.000"])
+    assert result[-1] == "X2.000"
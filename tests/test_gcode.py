@@ -0,0 +1,25 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from shapely.geometry import box
+from cam.gcode import link_rings
+
+def square(x0, y0, x1, y1):
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+
+def test_link_rings_joins_nearby_offsets():
+    area = box(0, 0, 20, 20)
+    rings = [square(0, 0, 20, 20), square(1.5, 1.5, 18.5, 18.5)]
+    assert len(link_rings(rings, area, 3.0)) == 1
+
+def test_link_rings_retracts_over_uncut_material():
+    area = box(0, 0, 60, 20)
+    rings = [square(0, 0, 20, 20), square(40, 0, 60, 20)]
+    assert len(link_rings(rings, area, 3.0)) == 2
+
+def test_link_rings_links_through_cleared_material():
+    area = box(0, 0, 60, 20)
+    # The long ring clears a channel along the bottom edge to the far square
+    rings = [square(0, 0, 60, 2), square(50, 0, 60, 20)]
+    polylines = link_rings(rings, area, 3.0, start = (0, 20))
+    assert len(polylines) == 1
@@ -0,0 +1,44 @@
+import io
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pytest
+import shapely.geometry
+from cam.rdkic import KicadBoard
+from cam.mill import MillingParams, contour_toolpaths, hole_toolpaths
+
+board_text = '''(kicad_pcb (version 20171130) (host pcbnew "(5.1.9)")
+  (net 0 "")
+  (net 1 GND)
+  (net 2 "Net-(R1-Pad2)")
+  (module Resistor_THT:R_Axial (layer F.Cu) (tedit 5AE5139B) (tstamp 5D000001)
+    (at 12 8 0)
+    (pad 1 thru_hole circle (at 0 0) (size 1.6 1.6) (drill 0.8) (layers *.Cu *.Mask) (net 1 GND))
+    (pad 2 thru_hole rect (at 7.62 0) (size 1.6 1.6) (drill 0.8) (layers *.Cu *.Mask) (net 2 "Net-(R1-Pad2)"))
+  )
+  (module Resistor_THT:R_Axial (layer F.Cu) (tedit 5AE5139B) (tstamp 5D000002)
+    (at 31 22 90)
+    (pad 1 thru_hole oval (at 0 0 90) (size 1.6 1.6) (drill 0.8) (layers *.Cu *.Mask) (net 2 "Net-(R1-Pad2)"))
+    (pad 2 thru_hole circle (at 2.54 0 90) (size 1.6 1.6) (drill 0.8) (layers *.Cu *.Mask) (net 1 GND))
+  )
+  (gr_line (start 0 0) (end 40 0) (layer Edge.Cuts) (width 0.05) (tstamp 5D000000))
+  (gr_line (start 40 0) (end 40 30) (layer Edge.Cuts) (width 0.05) (tstamp 5D000000))
+  (gr_line (start 40 30) (end 0 30) (layer Edge.Cuts) (width 0.05) (tstamp 5D000000))
+  (gr_line (start 0 30) (end 0 0) (layer Edge.Cuts) (width 0.05) (tstamp 5D000000))
+  (segment (start 19.62 8) (end 31 22) (width 0.25) (layer F.Cu) (net 2) (tstamp 5D000003))
+  (segment (start 12 8) (end 31 19.46) (width 0.25) (layer B.Cu) (net 1) (tstamp 5D000004))
+)
+'''
+
+@pytest.mark.parametrize("backend", ["qt", "shapely"])
+@pytest.mark.parametrize("layer", ["F.Cu", "B.Cu"])
+def test_holes_inside_isolation_contours(backend, layer):
+    board = KicadBoard(io.StringIO(board_text), streaming = True)
+    params = MillingParams()
+    params.backend = backend
+    contours, openlist = contour_toolpaths(board, layer, params)
+    polygons = [shapely.geometry.Polygon(c) for c in contours if len(c) > 2]
+    holes = hole_toolpaths(board, layer, params)
+    assert len(holes) == 4
+    for x, y, drillx, drilly in holes:
+        assert any(p.contains(shapely.geometry.Point(x, y)) for p in polygons)